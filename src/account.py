@@ -1,9 +1,16 @@
-import aiohttp
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from database import Base, engine, SessionLocal, AccountDB
 import time
+import aiohttp
 from utils.logger_config import get_logger
+from http_client import http_client, antgst_url
+from account_pool import account_pool
+from db_writer import db_writer
+from login_coordinator import login_coordinator, token_refresh_config
+from metrics import account_logins, health_sweep_seconds
+from retry_policy import OK, AUTH, RetryExhausted, classify, login_retry_policy
+from sqlalchemy.orm.attributes import set_committed_value
 import asyncio
 from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -26,17 +33,36 @@ class Account(BaseModel):
         return cls.parse_obj(obj.__dict__)
 
 
+class HealthCheckConfig:
+    """Knobs of the periodic account health sweep"""
+
+    interval = 1200  # seconds between sweeps while every account is idle
+    max_interval = 3600  # seconds between sweeps while none is
+    idle_after = 600  # an account the spider used more recently is not probed
+    concurrency = 30  # accounts checked at the same time, the per-host pool limit
+    request_timeout = 15  # seconds for one isCommonUser probe
+
+
+health_check_config = HealthCheckConfig()
+
+
 class AccountManager:
-    def __init__(self):
+    def __init__(self, start_health_check: bool = True):
         self.engine = engine
         Base.metadata.create_all(self.engine)
         self.session = SessionLocal()
-        self.health_check_url = "https://web.antgst.com/antgst/sys/user/isCommonUser"
+        self.health_check_url = antgst_url("/sys/user/isCommonUser")
         self.scheduler = AsyncIOScheduler()
         self.health_check_task = None
+        self.token_refresh_task = None
+        self.last_sweep: Optional[dict] = None
         self.loop = asyncio.get_event_loop()
-        logger.info("AccountManager initialized, starting health check task...")
-        self.start_health_check_task()
+        # tokens the spider sees refused are renewed at once, not on the next sweep
+        login_coordinator.renewer = self.login_by_name
+        if start_health_check:
+            logger.info("AccountManager initialized, starting health check task...")
+            self.start_health_check_task()
+            self.start_token_refresh_task()
 
     def start_health_check_task(self):
         """Start the periodic health check task"""
@@ -50,65 +76,191 @@ class AccountManager:
                         await self.periodic_health_check()
                     except Exception as e:
                         logger.error(f"Error in periodic health check loop: {str(e)}")
-                    logger.debug("Sleeping for 10 minutes before next health check")
-                    await asyncio.sleep(1200)
+                    interval = self.next_sweep_interval()
+                    logger.debug(
+                        f"Sleeping for {interval:.0f}s before next health check"
+                    )
+                    await asyncio.sleep(interval)
 
             self.health_check_task = asyncio.ensure_future(run_periodic())
             logger.info(
                 f"Health check task created with ID: {id(self.health_check_task)}"
             )
 
+    def start_token_refresh_task(self):
+        """Start renewing tokens before they expire"""
+        if self.token_refresh_task is None:
+
+            async def run_periodic():
+                while True:
+                    try:
+                        await self.refresh_tokens()
+                    except Exception as e:
+                        logger.error(f"Error in token refresh loop: {str(e)}")
+                    await asyncio.sleep(token_refresh_config.interval)
+
+            self.token_refresh_task = asyncio.ensure_future(run_periodic())
+
+    async def refresh_tokens(self) -> int:
+        """Log in again the accounts whose token is about to expire, returns how many"""
+        if login_coordinator.lifetime() is None:
+            return 0
+        await db_writer.flush()
+        accounts = (
+            self.session.query(AccountDB)
+            .filter(
+                AccountDB.is_active == True,
+                AccountDB.is_online == True,
+                AccountDB.token != None,
+            )
+            .populate_existing()
+            .all()
+        )
+        for account in accounts:
+            # logins of other processes arrive through the database
+            login_coordinator.token_issued(account.username, account.token_issued_at)
+        due = [a for a in accounts if login_coordinator.due(a.username)]
+        if not due:
+            return 0
+        logger.info(f"Renewing {len(due)} tokens before they expire")
+        semaphore = asyncio.Semaphore(token_refresh_config.concurrency)
+
+        async def renew(account: AccountDB) -> bool:
+            async with semaphore:
+                return await self.login(account)
+
+        results = await asyncio.gather(*(renew(account) for account in due))
+        return sum(results)
+
+    def _save(self, account: AccountDB, **fields):
+        """Update an account in memory now and in the database on the next writer flush"""
+        for name, value in fields.items():
+            set_committed_value(account, name, value)
+        db_writer.update_account(str(account.username), **fields)
+
     async def check_account_health(self, account: AccountDB) -> bool:
         """Check if an account is healthy and online"""
         if not account.is_active is True or account.token is None:
             return False
 
         headers = {"X-Access-Token": str(account.token)}
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(
-                    self.health_check_url, headers=headers
-                ) as response:
-                    if response.status == 200:
-                        if account.is_online is False:
-                            account.is_online = True  # type: ignore
-                            self.session.commit()
-                        return True
-            except Exception as e:
-                logger.error(f"Health check failed for {account.username}: {str(e)}")
+        session = http_client.get_session()
+        timeout = aiohttp.ClientTimeout(total=health_check_config.request_timeout)
+        try:
+            async with session.get(
+                self.health_check_url, headers=headers, timeout=timeout
+            ) as response:
+                if response.status == 200:
+                    if account.is_online is False:
+                        self._save(account, is_online=True)
+                    account_pool.set_online(account.username, account.token)
+                    account_pool.mark_ok(account.username)
+                    return True
+                if classify(status=response.status) == AUTH:
+                    login_coordinator.token_expired(account.username)
+        except Exception as e:
+            logger.error(f"Health check failed for {account.username}: {str(e)}")
 
         # If we reach here, either the request failed or returned non-200
         if account.is_active:
             # Try to login again
             login_success = await self.login(account)
             if not login_success:
-                account.is_online = False  # type: ignore
-                self.session.commit()
+                self._save(account, is_online=False)
+                account_pool.set_offline(account.username)
             return login_success
         return False
 
+    async def _check_with_limit(
+        self, account: AccountDB, semaphore: asyncio.Semaphore
+    ) -> bool:
+        async with semaphore:
+            logger.info(f"Checking health for account: {account.username}")
+            try:
+                is_healthy = await self.check_account_health(account)
+            except Exception as e:
+                logger.error(f"Health check error for {account.username}: {str(e)}")
+                is_healthy = False
+            logger.info(
+                f"Health check for {account.username}: {'healthy' if is_healthy else 'unhealthy'}"
+            )
+            return is_healthy
+
     async def periodic_health_check(self):
-        """Run health checks for all active accounts"""
+        """Run health checks for all active accounts, concurrently up to the configured limit"""
         logger.debug("Starting periodic health check")
+        started = time.monotonic()
         try:
+            # queued writes first, so reloading the rows does not undo them
+            await db_writer.flush()
             accounts = (
-                self.session.query(AccountDB).filter(AccountDB.is_active == True).all()
+                self.session.query(AccountDB)
+                .filter(AccountDB.is_active == True)
+                .populate_existing()
+                .all()
             )
             logger.info(f"Found {len(accounts)} active accounts to check")
             for account in accounts:
-                logger.info(f"Checking health for account: {account.username}")
-                is_healthy = await self.check_account_health(account)
-                logger.info(
-                    f"Health check for {account.username}: {'healthy' if is_healthy else 'unhealthy'}"
+                login_coordinator.token_issued(
+                    account.username, account.token_issued_at
                 )
+            # accounts the spider used a moment ago are known to work
+            idle = [account for account in accounts if self._idle(account)]
+            semaphore = asyncio.Semaphore(max(1, health_check_config.concurrency))
+            results = await asyncio.gather(
+                *(self._check_with_limit(account, semaphore) for account in idle)
+            )
+            duration = time.monotonic() - started
+            health_sweep_seconds.observe(duration)
+            passed = len(accounts) - len(idle)
+            self.last_sweep = {
+                "finished_at": datetime.now(),
+                "duration": duration,
+                "checked": len(accounts),
+                "probed": len(idle),
+                "healthy": passed + sum(1 for healthy in results if healthy),
+            }
+            logger.info(
+                f"Health sweep checked {len(accounts)} accounts in {duration:.2f}s, "
+                f"probed {len(idle)} idle ones, {self.last_sweep['healthy']} healthy"
+            )
         except Exception as e:
             logger.error(f"Error in periodic health check: {str(e)}")
         finally:
             logger.debug("Completed periodic health check")
 
+    @staticmethod
+    def _idle(account: AccountDB) -> bool:
+        if not account.is_online or account.last_ok_at is None:
+            return True
+        age = (datetime.now() - account.last_ok_at).total_seconds()
+        return age >= health_check_config.idle_after
+
+    def next_sweep_interval(self) -> float:
+        """Sweep less often the fewer accounts were idle, the spider checks the rest"""
+        sweep = self.last_sweep
+        if not sweep or not sweep["checked"]:
+            return health_check_config.interval
+        busy = 1 - sweep["probed"] / sweep["checked"]
+        return health_check_config.interval + busy * (
+            health_check_config.max_interval - health_check_config.interval
+        )
+
+    def stop_health_check_task(self):
+        """Stop the periodic health checks, another process runs them from now on"""
+        if self.health_check_task is not None:
+            self.health_check_task.cancel()
+            self.health_check_task = None
+
+    def stop_token_refresh_task(self):
+        if self.token_refresh_task is not None:
+            self.token_refresh_task.cancel()
+            self.token_refresh_task = None
+
     async def cleanup(self):
         """Cleanup method to be called when shutting down"""
         logger.info("Starting cleanup process")
+        self.stop_token_refresh_task()
         if self.health_check_task:
             logger.info("Canceling health check task")
             self.health_check_task.cancel()
@@ -135,64 +287,114 @@ class AccountManager:
         if account:
             self.session.delete(account)
             self.session.commit()
+            account_pool.set_offline(username)
             logger.info(f"Deleted account: {username}")
             return True
         logger.warning(f"Failed to delete account: {username} not found")
         return False
 
     def get_accounts(self) -> List[Account]:
-        accounts = self.session.query(AccountDB).all()
-        if not accounts:
-            logger.debug("No accounts found in database")
-            return []
-        logger.debug(f"Retrieved {len(accounts)} accounts from database")
-        return [Account.from_orm(acc) for acc in accounts]
+        # a short-lived session shows what other writers stored without
+        # reloading the rows the health checks are working on
+        session = SessionLocal()
+        try:
+            accounts = session.query(AccountDB).all()
+            if not accounts:
+                logger.debug("No accounts found in database")
+                return []
+            logger.debug(f"Retrieved {len(accounts)} accounts from database")
+            return [Account.from_orm(acc) for acc in accounts]
+        finally:
+            session.close()
 
     async def set_active_status(self, username: str, status: bool) -> bool:
         account = (
             self.session.query(AccountDB).filter(AccountDB.username == username).first()
         )
         if account:
-            account.is_active = status  # type: ignore
-            self.session.commit()
+            await db_writer.run(
+                lambda session: session.query(AccountDB)
+                .filter(AccountDB.username == username)
+                .update({"is_active": status})
+            )
+            set_committed_value(account, "is_active", status)
+            if not status:
+                account_pool.set_offline(username)
+            elif account.is_online and account.token:
+                account_pool.set_online(username, account.token)
             logger.info(f"Set account {username} active status to: {status}")
             return True
         logger.warning(f"Failed to set active status: {username} not found")
         return False
 
-    async def login(self, account: AccountDB) -> bool:
-        """Internal method to handle login logic with an existing account object"""
+    async def _login_attempt(self, account: AccountDB) -> Tuple[str, Optional[str]]:
+        """One captcha + login round trip, returns (error class, token)"""
         timestamp = int(time.time() * 1000)
-        url = f"https://web.antgst.com/antgst/sys/getCheckCode?_t={timestamp}"
+        url = antgst_url(f"/sys/getCheckCode?_t={timestamp}")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    code = data["result"]["code"]
-                    key = data["result"]["key"]
-                    login_data = {
-                        "username": account.username,
-                        "password": account.password,
-                        "captcha": code,
-                        "checkKey": key,
-                        "remember_me": True,
-                    }
-
-                    async with session.post(
-                        "https://web.antgst.com/antgst/sys/login", json=login_data
-                    ) as login_response:
-                        if login_response.status == 200:
-                            login_json = await login_response.json()
-                            token = login_json["result"]["token"]
-                            account.token = token  # type: ignore
-                            account.is_online = True  # type: ignore
-                            self.session.commit()
-                            logger.info(
-                                f"login user: {account.username}, token: {token}"
-                            )
-                            return True
-        return False
+        session = http_client.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                return classify(status=response.status), None
+            data = await response.json()
+            code = data["result"]["code"]
+            key = data["result"]["key"]
+        login_data = {
+            "username": account.username,
+            "password": account.password,
+            "captcha": code,
+            "checkKey": key,
+            "remember_me": True,
+        }
+
+        async with session.post(
+            antgst_url("/sys/login"), json=login_data
+        ) as login_response:
+            if login_response.status != 200:
+                return classify(status=login_response.status), None
+            login_json = await login_response.json()
+            if classify(payload=login_json) != OK:
+                # a rejected login is the credentials, trying again will not help
+                return AUTH, None
+            return OK, login_json["result"]["token"]
+
+    async def login(self, account: AccountDB) -> bool:
+        """Log an account in, joining the login already in flight for it if any"""
+        return await login_coordinator.run(
+            str(account.username), lambda: self._login(account)
+        )
+
+    async def login_by_name(self, username: str) -> bool:
+        """Log an active account in again, e.g. after the spider got a 401 with it"""
+        account = (
+            self.session.query(AccountDB)
+            .filter(AccountDB.username == username, AccountDB.is_active == True)
+            .first()
+        )
+        if account is None:
+            return False
+        try:
+            return await self.login(account)
+        except Exception as e:
+            logger.error(f"Error logging in {username} again: {str(e)}")
+            return False
+
+    async def _login(self, account: AccountDB) -> bool:
+        try:
+            token = await login_retry_policy.run(
+                lambda: self._login_attempt(account), f"login {account.username}"
+            )
+        except RetryExhausted as e:
+            account_logins.inc(result="failure")
+            logger.error(f"Login failed for user: {account.username}, {str(e)}")
+            return False
+        account_logins.inc(result="success")
+        issued_at = datetime.now()
+        self._save(account, token=token, is_online=True, token_issued_at=issued_at)
+        login_coordinator.token_issued(account.username, issued_at)
+        account_pool.set_online(account.username, token)
+        logger.info(f"login user: {account.username}, token: {token}")
+        return True
 
     async def logout(self, account: AccountDB) -> bool:
         """Logout an account and clear its token"""
@@ -200,17 +402,16 @@ class AccountManager:
             logger.warning(f"No token found for user: {account.username}")
             return False
 
-        logout_url = "https://web.antgst.com/antgst/sys/logout"
+        logout_url = antgst_url("/sys/logout")
         headers = {"X-Access-Token": str(account.token)}  # type: ignore
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(logout_url, headers=headers) as response:
-                if response.status != 200:
-                    logger.error(f"Logout failed for user: {account.username}")
-                    return False
-
-                account.token = None  # type: ignore
-                account.is_online = False  # type: ignore
-                self.session.commit()
-                logger.info(f"Logout user: {account.username}")
-                return True
+        session = http_client.get_session()
+        async with session.get(logout_url, headers=headers) as response:
+            if response.status != 200:
+                logger.error(f"Logout failed for user: {account.username}")
+                return False
+
+            self._save(account, token=None, is_online=False)
+            account_pool.set_offline(account.username)
+            logger.info(f"Logout user: {account.username}")
+            return True
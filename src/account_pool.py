@@ -0,0 +1,201 @@
+import asyncio
+import math
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from database import SessionLocal, AccountDB
+from db_writer import db_writer
+from metrics import accounts_online
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+OK_SAVE_INTERVAL = 60  # seconds between last_ok_at writes of one account
+RECLAIM_INTERVAL = 5  # seconds a waiting acquire() sleeps at most
+
+
+class PooledAccount:
+    """In-memory view of one online account and its token"""
+
+    def __init__(self, username: str, token: Optional[str]):
+        self.username = username
+        self.token = token
+        self.in_use = False
+        self.holder: Optional[asyncio.Future] = None  # task that acquired it
+        self.last_used = 0.0
+        self.cooldown_until = 0.0
+        self.requests = 0
+
+
+class AccountPool:
+    """
+    Online accounts held in memory for the spider's hot loop.
+
+    Accounts are handed out least-recently-used first and each one rests for
+    a per-account cooldown after every request, so load spreads over all
+    logged-in accounts. Health checks, logins and 401s keep it up to date
+    directly; the database is read when the pool is first used, and again
+    by reload() in worker processes, whose accounts other processes check.
+    A worker only holds the accounts assign() gives it, the other workers
+    spider with the rest.
+    """
+
+    def __init__(self):
+        self.accounts: Dict[str, PooledAccount] = {}
+        self.owns: Callable[[str], bool] = lambda username: True
+        self.loaded = False
+        self.changed = asyncio.Event()
+        self.ok_saved: Dict[str, float] = {}  # username -> last_ok_at written
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        self.reload()
+        logger.info(f"Account pool loaded with {len(self.accounts)} online accounts")
+
+    def assign(self, owns: Callable[[str], bool]):
+        """Hold only the accounts owns() is True for, from the next reload on"""
+        self.owns = owns
+
+    def reload(self):
+        """Match the accounts online in the database, keeping the state of known ones"""
+        session = SessionLocal()
+        try:
+            online = {
+                account.username: account.token
+                for account in session.query(AccountDB)
+                .filter(AccountDB.is_active == True, AccountDB.is_online == True)
+                .all()
+            }
+        finally:
+            session.close()
+        online = {
+            username: token for username, token in online.items() if self.owns(username)
+        }
+        for username in list(self.accounts):
+            if username not in online:
+                del self.accounts[username]
+        for username, token in online.items():
+            account = self.accounts.get(username)
+            if account is None:
+                self.accounts[username] = PooledAccount(username, token)
+            else:
+                account.token = token
+        self.loaded = True
+        self._notify()
+
+    def _notify(self):
+        accounts_online.set(len(self.accounts))
+        self.changed.set()
+
+    def set_online(self, username: str, token: Optional[str]):
+        """Record a working token, called after a login or a passing health check"""
+        self.ensure_loaded()
+        if not self.owns(username):
+            return
+        account = self.accounts.get(username)
+        if account is None:
+            self.accounts[username] = PooledAccount(username, token)
+            logger.info(f"Account pool: {username} online")
+        else:
+            account.token = token
+        self._notify()
+
+    def set_offline(self, username: str):
+        """Take an account out of rotation, e.g. after a 401 or a failed login"""
+        self.ensure_loaded()
+        if self.accounts.pop(username, None) is not None:
+            logger.info(f"Account pool: {username} offline")
+        self._notify()
+
+    def mark_ok(self, username: str):
+        """An authenticated request of username passed, the health sweep can skip it"""
+        now = time.monotonic()
+        if now - self.ok_saved.get(username, -OK_SAVE_INTERVAL) >= OK_SAVE_INTERVAL:
+            self.ok_saved[username] = now
+            db_writer.update_account(username, last_ok_at=datetime.now())
+
+    def online_count(self) -> int:
+        self.ensure_loaded()
+        return len(self.accounts)
+
+    def usernames(self) -> List[str]:
+        self.ensure_loaded()
+        return list(self.accounts)
+
+    def reclaim(self) -> int:
+        """Free the accounts whose holder ended without releasing them, returns how many"""
+        freed = 0
+        for account in self.accounts.values():
+            if account.in_use and (account.holder is None or account.holder.done()):
+                account.in_use = False
+                account.holder = None
+                freed += 1
+        if freed:
+            logger.warning(f"Account pool: reclaimed {freed} accounts left in use")
+            self._notify()
+        return freed
+
+    def _pick(self, now: float) -> Optional[PooledAccount]:
+        ready = [
+            account
+            for account in self.accounts.values()
+            if not account.in_use and account.cooldown_until <= now
+        ]
+        if not ready:
+            return None
+        return min(ready, key=lambda account: account.last_used)
+
+    async def acquire(self, timeout: Optional[float] = None) -> Optional[PooledAccount]:
+        """
+        Wait for the least recently used account that is off cooldown.
+
+        Without a timeout it waits as long as any account is online, and
+        returns None once none is.
+        """
+        self.ensure_loaded()
+        deadline = time.monotonic() + (timeout if timeout is not None else math.inf)
+        while True:
+            self.reclaim()
+            now = time.monotonic()
+            account = self._pick(now)
+            if account is not None:
+                account.in_use = True
+                account.holder = asyncio.current_task()
+                account.last_used = now
+                account.requests += 1
+                return account
+            if now >= deadline or not self.accounts:
+                return None
+            # sleep until the next cooldown ends or the pool changes, looking
+            # again now and then for accounts whose holder died
+            cooling = [a.cooldown_until for a in self.accounts.values() if not a.in_use]
+            wake = min(cooling + [deadline, now + RECLAIM_INTERVAL]) - now
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=max(wake, 0.01))
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, account: PooledAccount, cooldown: float):
+        """Hand an account back, it can be used again after cooldown seconds"""
+        account.in_use = False
+        account.holder = None
+        account.cooldown_until = time.monotonic() + cooldown
+        self._notify()
+
+    def snapshot(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "username": account.username,
+                "in_use": account.in_use,
+                "requests": account.requests,
+                "cooldown": max(0.0, account.cooldown_until - now),
+            }
+            for account in self.accounts.values()
+        ]
+
+
+account_pool = AccountPool()
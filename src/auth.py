@@ -1,14 +1,75 @@
-import aiohttp
-from typing import List, Optional, Dict
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Dict
 from utils.logger_config import get_logger
+from http_client import http_client, antgst_url
+from metrics import auth_cache_lookups
 
 logger = get_logger(__name__)
 
+BULK_CONCURRENCY = 10  # user lookups and role deletes in flight in a bulk change
+BULK_CHUNK_SIZE = 100  # users per addSysUserRole call
+
+
+class AuthCacheConfig:
+    """How long upstream user lookups are reused"""
+
+    user_ttl = 24 * 3600  # user ids never change
+    role_ttl = 600  # roles change through this app, which drops what it changes
+    max_size = 10000  # entries per cache, least recently used go first
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire ttl seconds after they were stored"""
+
+    def __init__(self, name: str, ttl: float, max_size: int):
+        self.name = name  # the cache label of auth_cache_lookups_total
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            auth_cache_lookups.inc(cache=self.name, result="hit")
+            return entry[1]
+        if entry is not None:
+            del self.entries[key]
+        auth_cache_lookups.inc(cache=self.name, result="miss")
+        return None
+
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+
+def parse_usernames(text: str) -> List[str]:
+    """Usernames separated by new lines, commas, semicolons or spaces, in order"""
+    usernames = []
+    for username in re.split(r"[\s,;]+", text):
+        username = username.strip().strip('"')
+        # a CSV export may start with a header row
+        if username and username.lower() not in ("username", "user_name"):
+            usernames.append(username)
+    return list(dict.fromkeys(usernames))
+
 
 class Auth:
-    def __init__(self):
+    def __init__(self, cache_config: AuthCacheConfig = AuthCacheConfig()):
+        # upstream lookups by username and by user id; a role change made
+        # here drops the roles of the users it touched
+        self.users = TTLCache("users", cache_config.user_ttl, cache_config.max_size)
+        self.roles = TTLCache("roles", cache_config.role_ttl, cache_config.max_size)
 
-        self.add_url = "https://web.antgst.com/antgst/;/sys/user/addSysUserRole"
+        self.add_url = antgst_url("/;/sys/user/addSysUserRole")
         # the add_url is POST request, the data is like this:
         # {
         #   "roleId": "743e6e95d9a4001e46a78c3606dcb15b",
@@ -16,18 +77,14 @@ class Auth:
         #        "e888946e0213c9a4685bd94e7f1563ae"
         #     ]
         # }
-        self.delete_url = "https://web.antgst.com/antgst/;/sys/user/deleteUserRole"
+        self.delete_url = antgst_url("/;/sys/user/deleteUserRole")
         # the delete_url is DELETE request, the prams is like this:
         # ?roleId=743e6e95d9a4001e46a78c3606dcb15b&userId=e888946e0213c9a4685bd94e7f1563ae
-        self.query_user_id_url = (
-            "https://web.antgst.com/antgst/;/sys/user/getUserListByName"
-        )
+        self.query_user_id_url = antgst_url("/;/sys/user/getUserListByName")
         # the query_user_id_url is GET request, the prams is like this:
         # userName=SS678
         self.upgrade_user_role_id = "743e6e95d9a4001e46a78c3606dcb15b"
-        self.query_user_role_url = (
-            "https://web.antgst.com/antgst/;/sys/user/queryUserRole"
-        )
+        self.query_user_role_url = antgst_url("/;/sys/user/queryUserRole")
         # the query_user_role_url is GET request, the prams is like this:
         # ?userid=e888946e0213c9a4685bd94e7f1563ae
         self.normal_user_role_id = "082678e5d9270824353a223a6727e009"
@@ -100,79 +157,160 @@ class Auth:
         except Exception:
             return False
 
+    async def change_authority_bulk(
+        self, usernames: List[str], action: str
+    ) -> List[Dict]:
+        """
+        Upgrade or downgrade many users at once, returns one result per user.
+
+        User ids (and for an upgrade the current roles) are looked up
+        concurrently, BULK_CONCURRENCY at a time; the new role is added with
+        one addSysUserRole call per BULK_CHUNK_SIZE users, and the old role,
+        which the API only deletes per user, is deleted concurrently again.
+        """
+        upgrade = action == "upgrade"
+        new_role = self.upgrade_user_role_id if upgrade else self.normal_user_role_id
+        old_role = self.normal_user_role_id if upgrade else self.upgrade_user_role_id
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+        results = {
+            username: {"username": username, "user_id": None, "success": False}
+            for username in usernames
+        }
+
+        async def resolve(username: str):
+            result = results[username]
+            async with semaphore:
+                try:
+                    users = await self.get_user_by_name(username)
+                    if not users or (not upgrade and users[0]["userName"] != username):
+                        result["status"] = "user not found"
+                        return
+                    result["user_id"] = users[0]["id"]
+                    if upgrade and await self.is_super_user(result["user_id"]):
+                        result.update(status="already a super user", success=True)
+                except Exception as e:
+                    # one odd answer must not cost the other users their change
+                    logger.error(f"Error looking up user {username}: {str(e)}")
+                    result.update(user_id=None, status="lookup failed")
+
+        async def delete_old_role(result: Dict):
+            async with semaphore:
+                try:
+                    deleted = await self.delete_user_role(old_role, result["user_id"])
+                except Exception as e:
+                    logger.error(
+                        f"Error deleting role of {result['username']}: {str(e)}"
+                    )
+                    deleted = False
+                if not deleted:
+                    # the new role is in place, as with a single change
+                    logger.error(
+                        f"Old role of {result['username']} not deleted, "
+                        f"it keeps both roles"
+                    )
+
+        await asyncio.gather(*(resolve(username) for username in usernames))
+        pending = [
+            result
+            for result in results.values()
+            if result["user_id"] and "status" not in result
+        ]
+        for start in range(0, len(pending), BULK_CHUNK_SIZE):
+            chunk = pending[start : start + BULK_CHUNK_SIZE]
+            added = await self.add_user_role(
+                new_role, [result["user_id"] for result in chunk]
+            )
+            for result in chunk:
+                result["success"] = added
+                result["status"] = (
+                    ("upgraded" if upgrade else "downgraded")
+                    if added
+                    else "failed to add role"
+                )
+        await asyncio.gather(
+            *(delete_old_role(result) for result in pending if result["success"])
+        )
+        succeeded = sum(result["success"] for result in results.values())
+        logger.info(f"Bulk {action}: {succeeded} of {len(results)} users done")
+        return list(results.values())
+
     async def add_user_role(self, role_id: str, user_ids: List[str]) -> bool:
         try:
-            async with aiohttp.ClientSession() as session:
-                data = {"roleId": role_id, "userIdList": user_ids}
-                logger.info(
-                    f"Adding user role - roleId: {role_id}, userIds: {user_ids}"
-                )
-                async with session.post(self.add_url, json=data) as response:
-                    success = response.status == 200
-                    if success:
-                        logger.info(
-                            f"Successfully added role {role_id} to users {user_ids}"
-                        )
-                    else:
-                        logger.error(
-                            f"Failed to add role {role_id} to users {user_ids}"
-                        )
-                    return success
+            session = http_client.get_session()
+            data = {"roleId": role_id, "userIdList": user_ids}
+            logger.info(f"Adding user role - roleId: {role_id}, userIds: {user_ids}")
+            async with session.post(self.add_url, json=data) as response:
+                success = response.status == 200
+                if success:
+                    logger.info(
+                        f"Successfully added role {role_id} to users {user_ids}"
+                    )
+                else:
+                    logger.error(f"Failed to add role {role_id} to users {user_ids}")
+                return success
         except Exception as e:
             logger.error(f"Error adding user role: {str(e)}")
             return False
+        finally:
+            # after the request, a lookup meanwhile may have cached the old roles
+            for user_id in user_ids:
+                self.roles.invalidate(user_id)
 
     async def delete_user_role(self, role_id: str, user_id: str) -> bool:
         try:
-            async with aiohttp.ClientSession() as session:
-                params = {"roleId": role_id, "userId": user_id}
-                logger.info(
-                    f"Deleting user role - roleId: {role_id}, userId: {user_id}"
-                )
-                async with session.delete(
-                    f"{self.delete_url}", params=params
-                ) as response:
-                    success = response.status == 200
-                    if success:
-                        logger.info(
-                            f"Successfully deleted role {role_id} from user {user_id}"
-                        )
-                    else:
-                        logger.error(
-                            f"Failed to delete role {role_id} from user {user_id}"
-                        )
-                    return success
+            session = http_client.get_session()
+            params = {"roleId": role_id, "userId": user_id}
+            logger.info(f"Deleting user role - roleId: {role_id}, userId: {user_id}")
+            async with session.delete(f"{self.delete_url}", params=params) as response:
+                success = response.status == 200
+                if success:
+                    logger.info(
+                        f"Successfully deleted role {role_id} from user {user_id}"
+                    )
+                else:
+                    logger.error(f"Failed to delete role {role_id} from user {user_id}")
+                return success
         except Exception as e:
             logger.error(f"Error deleting user role: {str(e)}")
             return False
+        finally:
+            self.roles.invalidate(user_id)
 
     async def get_user_by_name(self, username: str) -> Optional[Dict]:
+        users = self.users.get(username)
+        if users is not None:
+            return users
         try:
-            async with aiohttp.ClientSession() as session:
-                params = {"userName": username}
-                async with session.get(
-                    self.query_user_id_url, params=params
-                ) as response:
-                    logger.info(f"get_user_by_name: {await response.json()}")
-                    if response.status == 200:
-                        return await response.json()
+            session = http_client.get_session()
+            params = {"userName": username}
+            async with session.get(self.query_user_id_url, params=params) as response:
+                if response.status != 200:
                     return None
+                users = await response.json()
+                logger.info(f"get_user_by_name: {users}")
         except Exception:
             return None
+        # only a list of users is worth keeping, an error body is asked again
+        if users and isinstance(users, list):
+            self.users.put(username, users)
+        return users
 
     async def query_user_role(self, user_id: str) -> Optional[Dict]:
+        roles = self.roles.get(user_id)
+        if roles is not None:
+            return roles
         try:
-            async with aiohttp.ClientSession() as session:
-                params = {"userid": user_id}
-                logger.info(f"Querying user roles for userId: {user_id}")
-                async with session.get(
-                    self.query_user_role_url, params=params
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"User roles query result: {result}")
-                        return result
-                    return None
+            session = http_client.get_session()
+            params = {"userid": user_id}
+            logger.info(f"Querying user roles for userId: {user_id}")
+            async with session.get(self.query_user_role_url, params=params) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    logger.info(f"User roles query result: {result}")
+                    if result and result.get("result") is not None:
+                        self.roles.put(user_id, result)
+                    return result
+                return None
         except Exception as e:
             logger.error(f"Error querying user roles: {str(e)}")
             return None
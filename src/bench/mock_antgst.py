@@ -0,0 +1,334 @@
+"""
+Local stand-in for web.antgst.com, for load tests and offline development.
+
+Serves the endpoints the spider, account and auth modules call, with
+configurable latency, error rate, throttling and data size. Point the app at
+it with ANTGST_BASE_URL=http://127.0.0.1:<port>/antgst.
+
+    python -m bench.mock_antgst --port 9000 --latency 0.05 --total-rows 90000
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+RECORD_FIELDS = [
+    "id",
+    "userName",
+    "countryName",
+    "operator",
+    "smsFrom",
+    "smsTo",
+    "message",
+    "sendResult",
+    "gatewayDr",
+    "gatewayRealDr",
+    "intervalTime",
+    "smsCount",
+    "smsFee",
+    "currency",
+    "sendDrStatus",
+    "resendDrTimes",
+    "sendTime",
+    "updateTime",
+    "gatewayName",
+    "gatewayResult",
+    "validateResult",
+    "action",
+]
+
+NORMAL_ROLE_ID = "082678e5d9270824353a223a6727e009"
+
+
+class MockConfig:
+    """How the mock upstream behaves"""
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        error_rate: float = 0.0,
+        throttle_rps: float = 0,
+        total_rows: int = 30000,
+        max_page_size: int = 3000,
+        token_ttl: float = 0,
+    ):
+        self.latency = latency  # seconds added to every response
+        self.jitter = jitter  # +- random seconds on top of latency
+        self.error_rate = error_rate  # share of requests answered with a 500
+        self.throttle_rps = throttle_rps  # requests per second per token, 0 is off
+        self.total_rows = total_rows  # rows of sendRecordList for every day
+        self.max_page_size = max_page_size
+        self.token_ttl = token_ttl  # seconds a token stays valid, 0 is forever
+
+
+def token_for(username: str) -> str:
+    """The token the mock issues to a user, benchmarks seed accounts with it"""
+    return f"mock-token-{username}"
+
+
+class MockAntgst:
+    """The mock server, its users and a count of the requests it served"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.tokens: Dict[str, str] = {}  # token -> username
+        self.issued: Dict[str, float] = {}  # token -> when it was issued
+        self.started = time.monotonic()  # seeded tokens count as issued here
+        self.logins = 0
+        self.roles: Dict[str, List[str]] = {}  # user id -> role ids
+        self.recent: Dict[str, deque] = {}  # token -> request times, for throttling
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.throttled = 0
+
+    async def _delay(self):
+        delay = self.config.latency + random.uniform(
+            -self.config.jitter, self.config.jitter
+        )
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _fail(self, token: str = "") -> Optional[web.Response]:
+        """A throttle or injected error response, None when the request goes through"""
+        if token and self.config.throttle_rps:
+            now = time.monotonic()
+            window = self.recent.setdefault(token, deque())
+            while window and window[0] < now - 1:
+                window.popleft()
+            if len(window) >= self.config.throttle_rps:
+                self.throttled += 1
+                return web.json_response(
+                    {"success": False, "code": 429, "message": "too many requests"},
+                    status=429,
+                )
+            window.append(now)
+        if random.random() < self.config.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"success": False, "code": 500, "message": "injected error"},
+                status=500,
+            )
+        return None
+
+    def _user(self, request: web.Request) -> Optional[str]:
+        """Username of the request token, None when it is unknown"""
+        token = request.headers.get("X-Access-Token", "")
+        if self.config.token_ttl:
+            issued = self.issued.get(token, self.started)
+            if time.monotonic() - issued > self.config.token_ttl:
+                return None
+        if token in self.tokens:
+            return self.tokens[token]
+        if token.startswith("mock-token-"):
+            return token[len("mock-token-") :]
+        return None
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        name = request.match_info.route.name or request.path
+        self.requests[name] = self.requests.get(name, 0) + 1
+        await self._delay()
+        failed = self._fail(request.headers.get("X-Access-Token", ""))
+        if failed is not None:
+            return failed
+        return await handler(request)
+
+    async def get_check_code(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "success": True,
+                "code": 200,
+                "result": {"code": "abcd", "key": str(random.random())},
+            }
+        )
+
+    async def login(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        username = data.get("username")
+        if not username or data.get("password") == "wrong":
+            return web.json_response(
+                {"success": False, "code": 500, "message": "wrong password"}
+            )
+        self.logins += 1
+        token = token_for(username)
+        if self.config.token_ttl:
+            # a fresh token per login, each one expiring on its own
+            token = f"{token}.{self.logins}"
+            self.issued[token] = time.monotonic()
+        self.tokens[token] = username
+        return web.json_response(
+            {"success": True, "code": 200, "result": {"token": token}}
+        )
+
+    async def logout(self, request: web.Request) -> web.Response:
+        self.tokens.pop(request.headers.get("X-Access-Token", ""), None)
+        return web.json_response({"success": True, "code": 200})
+
+    async def is_common_user(self, request: web.Request) -> web.Response:
+        if self._user(request) is None:
+            return web.json_response(
+                {"success": False, "code": 401, "message": "token invalid"},
+                status=401,
+            )
+        return web.json_response({"success": True, "code": 200, "result": True})
+
+    async def send_record_list(self, request: web.Request) -> web.Response:
+        username = self._user(request)
+        if username is None:
+            return web.json_response(
+                {"success": False, "code": 401, "message": "token invalid"},
+                status=401,
+            )
+        page_no = int(request.query.get("pageNo", 0))
+        page_size = min(
+            int(request.query.get("pageSize", 10)), self.config.max_page_size
+        )
+        day = request.query.get("day", "")
+        total = self.config.total_rows
+        start = page_no * page_size
+        records = [
+            self._record(day, index)
+            for index in range(start, min(total, start + page_size))
+        ]
+        body = {
+            "success": True,
+            "code": 200,
+            "result": {
+                "records": records,
+                "total": total,
+                "size": page_size,
+                "current": page_no,
+                "pages": math.ceil(total / page_size),
+            },
+        }
+        return web.Response(text=json.dumps(body), content_type="application/json")
+
+    @staticmethod
+    def _record(day: str, index: int) -> dict:
+        # newest first like the real list, two records per second
+        created = datetime.strptime(day or "2024-01-01", "%Y-%m-%d") + timedelta(
+            days=1, seconds=-1 - index // 2
+        )
+        created = created.strftime("%Y-%m-%d %H:%M:%S")
+        record = {field: f"{field}-{index % 97}" for field in RECORD_FIELDS}
+        record.update(
+            {
+                "id": f"{day}-{index}",
+                "smsTo": f"55{index:09d}",
+                "intervalTime": index % 60,
+                "smsCount": 1,
+                "smsFee": 0.0125,
+                "resendDrTimes": 0,
+                "createTime": created,
+                "sendTime": created,
+                "updateTime": created,
+            }
+        )
+        return record
+
+    async def get_user_list_by_name(self, request: web.Request) -> web.Response:
+        username = request.query.get("userName", "")
+        user_id = f"id-{username}"
+        self.roles.setdefault(user_id, [NORMAL_ROLE_ID])
+        return web.json_response([{"id": user_id, "userName": username}])
+
+    async def query_user_role(self, request: web.Request) -> web.Response:
+        roles = self.roles.get(request.query.get("userid", ""), [])
+        return web.json_response({"success": True, "code": 200, "result": roles})
+
+    async def add_user_role(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        for user_id in data.get("userIdList", []):
+            roles = self.roles.setdefault(user_id, [])
+            if data.get("roleId") not in roles:
+                roles.append(data.get("roleId"))
+        return web.json_response({"success": True, "code": 200})
+
+    async def delete_user_role(self, request: web.Request) -> web.Response:
+        roles = self.roles.get(request.query.get("userId", ""), [])
+        if request.query.get("roleId") in roles:
+            roles.remove(request.query.get("roleId"))
+        return web.json_response({"success": True, "code": 200})
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        routes = [
+            ("GET", "/sys/getCheckCode", self.get_check_code),
+            ("POST", "/sys/login", self.login),
+            ("GET", "/sys/logout", self.logout),
+            ("GET", "/sys/user/isCommonUser", self.is_common_user),
+            (
+                "GET",
+                "/sms/otpPremium/channel/sendRecordList",
+                self.send_record_list,
+            ),
+            ("GET", "/;/sys/user/getUserListByName", self.get_user_list_by_name),
+            ("GET", "/;/sys/user/queryUserRole", self.query_user_role),
+            ("POST", "/;/sys/user/addSysUserRole", self.add_user_role),
+            ("DELETE", "/;/sys/user/deleteUserRole", self.delete_user_role),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(
+                method, "/antgst" + path, handler, name=path.split("/")[-1]
+            )
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": self.requests,
+                "errors": self.errors,
+                "throttled": self.throttled,
+                "logins": self.logins,
+            }
+        )
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local stand-in for web.antgst.com")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rps", type=float, default=0)
+    parser.add_argument("--total-rows", type=int, default=30000)
+    parser.add_argument("--max-page-size", type=int, default=3000)
+    parser.add_argument("--token-ttl", type=float, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rps=args.throttle_rps,
+        total_rows=args.total_rows,
+        max_page_size=args.max_page_size,
+        token_ttl=args.token_ttl,
+    )
+    mock = MockAntgst(config)
+    url = f"http://{args.host}:{args.port}/antgst"
+    # printed once the port is bound, the benchmark waits for this line
+    web.run_app(
+        mock.app(),
+        host=args.host,
+        port=args.port,
+        print=lambda _: print(f"mock antgst listening on {url}", flush=True),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+End-to-end benchmark of the spider, the account health check and the auth
+flows against the local mock upstream (bench/mock_antgst.py).
+
+Starts the mock in a subprocess, points the app at it through
+ANTGST_BASE_URL and runs each phase in a fresh working directory, so the
+real spider.db and output/ are never touched.
+
+    cd src && python -m bench.run_bench --accounts 20 --total-rows 300000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import aiohttp
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ["health", "spider", "auth", "auth_bulk"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    """Run the mock upstream in its own process, so it does not skew our CPU and RSS"""
+    command = [
+        sys.executable,
+        "-m",
+        "bench.mock_antgst",
+        "--port",
+        str(port),
+        "--latency",
+        str(args.latency),
+        "--jitter",
+        str(args.jitter),
+        "--error-rate",
+        str(args.error_rate),
+        "--throttle-rps",
+        str(args.throttle_rps),
+        "--total-rows",
+        str(args.total_rows),
+    ]
+    mock = subprocess.Popen(command, cwd=SRC_DIR, stdout=subprocess.PIPE, text=True)
+    line = mock.stdout.readline()
+    if "listening" not in line:
+        mock.kill()
+        raise RuntimeError(f"mock antgst did not start: {line!r}")
+    return mock
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, ru_maxrss is in KiB on Linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LatencyRecorder:
+    """Times every request of the shared aiohttp session, up to the response headers"""
+
+    def __init__(self):
+        self.samples: List[float] = []
+        self.errors = 0
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self._on_start)
+        self.trace_config.on_request_end.append(self._on_end)
+        self.trace_config.on_request_exception.append(self._on_exception)
+
+    def reset(self):
+        self.samples = []
+        self.errors = 0
+
+    async def _on_start(self, session, context, params):
+        context.started = time.monotonic()
+
+    async def _on_end(self, session, context, params):
+        self.samples.append(time.monotonic() - context.started)
+        if params.response.status != 200:
+            self.errors += 1
+
+    async def _on_exception(self, session, context, params):
+        self.errors += 1
+
+    def report(self, name: str, seconds: float, **counts) -> dict:
+        result = {
+            "phase": name,
+            "seconds": round(seconds, 3),
+            "requests": len(self.samples),
+            "errors": self.errors,
+        }
+        for key, value in counts.items():
+            result[key] = value
+            result[f"{key}_per_s"] = round(value / seconds, 1) if seconds else None
+        for key, q in (("p50_ms", 0.5), ("p99_ms", 0.99)):
+            value = percentile(self.samples, q)
+            result[key] = None if value is None else round(value * 1000, 1)
+        result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        return result
+
+
+def seed_accounts(args: argparse.Namespace):
+    from bench.mock_antgst import token_for
+    from database import SessionLocal, AccountDB
+
+    session = SessionLocal()
+    stale = int(args.accounts * args.stale_tokens)
+    for index in range(args.accounts):
+        username = f"bench{index:04d}"
+        # a stale token fails the health check and makes it log in again
+        token = f"stale-{username}" if index < stale else token_for(username)
+        session.merge(
+            AccountDB(
+                username=username,
+                password="bench",
+                token=token,
+                is_online=True,
+                is_active=True,
+            )
+        )
+    session.commit()
+    session.close()
+
+
+class LoopLagProbe:
+    """Sleeps interval seconds in a loop and records how late the loop woke it up"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self.probe: Optional[asyncio.Future] = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.monotonic() - started - self.interval)
+
+    def start(self):
+        self.samples = []
+        self.probe = asyncio.ensure_future(self._run())
+
+    def stop(self) -> dict:
+        self.probe.cancel()
+        return {
+            "loop_lag_p99_ms": round((percentile(self.samples, 0.99) or 0) * 1000, 1),
+            "loop_lag_max_ms": round(max(self.samples, default=0) * 1000, 1),
+        }
+
+
+async def bench_health(args: argparse.Namespace, recorder: LatencyRecorder) -> dict:
+    from account import AccountManager, health_check_config
+
+    manager = AccountManager()
+    # only the sweep we time below, not the background loop
+    manager.health_check_task.cancel()
+    health_check_config.concurrency = args.concurrency
+    recorder.reset()
+    started = time.monotonic()
+    await manager.periodic_health_check()
+    seconds = time.monotonic() - started
+    sweep = manager.last_sweep or {}
+    result = recorder.report("health", seconds, accounts=sweep.get("checked", 0))
+    result["healthy"] = sweep.get("healthy", 0)
+    return result
+
+
+async def bench_spider(args: argparse.Namespace, recorder: LatencyRecorder) -> dict:
+    from database import SessionLocal, TaskCheckpointDB, TaskDB
+    from db_writer import db_writer
+    from task_manager import TaskManager, spider_config
+
+    spider_config.sleep_time = args.sleep
+    spider_config.adaptive = False
+    manager = TaskManager()
+    task = await manager.create_task(args.date, args.output_format)
+    recorder.reset()
+    lag = LoopLagProbe()
+    lag.start()
+    started = time.monotonic()
+    await manager.start_task(task.id)
+    await TaskManager.running[task.id]
+    seconds = time.monotonic() - started
+    loop_lag = lag.stop()
+    await db_writer.flush()
+
+    session = SessionLocal()
+    task = session.get(TaskDB, task.id)
+    checkpoint = (
+        session.query(TaskCheckpointDB)
+        .filter(TaskCheckpointDB.task_id == task.id)
+        .order_by(TaskCheckpointDB.id.desc())
+        .first()
+    )
+    pages, rows = task.current_page, checkpoint.rows if checkpoint else 0
+    if not task.done:
+        print(f"spider did not finish: {task.error or 'stopped'}", file=sys.stderr)
+    session.close()
+    result = recorder.report("spider", seconds, pages=pages, rows=rows)
+    result.update(loop_lag)
+    return result
+
+
+async def bench_auth(args: argparse.Namespace, recorder: LatencyRecorder) -> dict:
+    from auth import Auth
+
+    auth = Auth()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def cycle(username: str) -> bool:
+        async with semaphore:
+            upgraded = await auth.upgrade_authority(username)
+            downgraded = await auth.downgrade_authority(username)
+            return upgraded and downgraded
+
+    recorder.reset()
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(cycle(f"user{index:04d}") for index in range(args.auth_users))
+    )
+    seconds = time.monotonic() - started
+    return recorder.report("auth", seconds, users=sum(results))
+
+
+async def bench_auth_bulk(args: argparse.Namespace, recorder: LatencyRecorder) -> dict:
+    from auth import Auth
+
+    auth = Auth()
+    usernames = [f"bulk{index:04d}" for index in range(args.auth_users)]
+    recorder.reset()
+    started = time.monotonic()
+    upgraded = await auth.change_authority_bulk(usernames, "upgrade")
+    downgraded = await auth.change_authority_bulk(usernames, "downgrade")
+    seconds = time.monotonic() - started
+    users = sum(
+        up["success"] and down["success"] for up, down in zip(upgraded, downgraded)
+    )
+    return recorder.report("auth_bulk", seconds, users=users)
+
+
+async def run(args: argparse.Namespace, base_url: str) -> List[dict]:
+    # the app modules read the base URL and open spider.db in the cwd on import
+    os.environ["ANTGST_BASE_URL"] = base_url
+    from http_client import http_client
+    from db_writer import db_writer
+
+    recorder = LatencyRecorder()
+    http_client.trace_configs.append(recorder.trace_config)
+    seed_accounts(args)
+    phases = {
+        "health": bench_health,
+        "spider": bench_spider,
+        "auth": bench_auth,
+        "auth_bulk": bench_auth_bulk,
+    }
+    results = []
+    try:
+        for name in args.phases:
+            results.append(await phases[name](args, recorder))
+    finally:
+        await db_writer.close()
+        await http_client.close()
+    return results
+
+
+def print_results(results: List[dict]):
+    for result in results:
+        print(f"== {result['phase']}")
+        for key, value in result.items():
+            if key != "phase":
+                print(f"  {key:>16}: {value}")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--phases", nargs="+", choices=PHASES, default=PHASES)
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--stale-tokens", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=30)
+    parser.add_argument("--auth-users", type=int, default=50)
+    parser.add_argument("--date", default="2024-01-01")
+    parser.add_argument("--output-format", default="csv")
+    parser.add_argument(
+        "--sleep", type=float, default=0, help="spider delay per account"
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rps", type=float, default=0)
+    parser.add_argument("--total-rows", type=int, default=90000)
+    parser.add_argument("--workdir", help="keep spider.db and output here")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    sys.path.insert(0, SRC_DIR)
+    port = free_port()
+    mock = start_mock(args, port)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="spider-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        results = asyncio.run(run(args, f"http://127.0.0.1:{port}/antgst"))
+    finally:
+        mock.terminate()
+        mock.wait()
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    print(f"work directory: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import case, func
+
+from database import CrawlPlanDB, SessionLocal, TaskDB
+from db_writer import db_writer
+from output_formats import available_formats, create_output, output_path
+from shared_settings import save_setting
+from task_manager import TaskManager
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class PlannerConfig:
+    """Knobs of the crawl planner"""
+
+    # spider tasks running at once, over every plan and manually started tasks;
+    # all of them share the account pool, so this caps contention, not accounts
+    max_running_tasks = 4
+    interval = 5  # seconds between scheduling rounds
+    max_days = 366  # longest date range of one plan
+
+
+planner_config = PlannerConfig()
+
+
+def expand_dates(start_date: str, end_date: str) -> List[str]:
+    """Every day from start_date to end_date inclusive, as YYYY-MM-DD"""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    if end < start:
+        raise ValueError("End date is before start date")
+    days = (end - start).days + 1
+    if days > planner_config.max_days:
+        raise ValueError(f"A plan covers at most {planner_config.max_days} days")
+    return [(start + timedelta(days=n)).strftime("%Y-%m-%d") for n in range(days)]
+
+
+def parse_country_codes(text: str) -> List[str]:
+    """Country codes separated by commas or spaces, e.g. "55, 0052" -> ["0055", "0052"]"""
+    codes = []
+    for code in text.replace(",", " ").split():
+        if not code.isdigit():
+            raise ValueError(f"Invalid country code: {code}")
+        code = code.zfill(4)
+        if code not in codes:
+            codes.append(code)
+    if not codes:
+        raise ValueError("At least one country code is required")
+    return codes
+
+
+class CrawlPlanner:
+    """
+    Expands a date range and a list of countries into one task per pair and
+    keeps up to planner_config.max_running_tasks of them running.
+
+    Planned tasks wait with TaskDB.queued set; each round starts queued tasks
+    of the plans that are not stopped, oldest plan and earliest date first,
+    while there are free slots. Every running task takes pages from the
+    shared account pool, so several small days crawl side by side instead of
+    each waiting for the head page of the one before it.
+    """
+
+    def __init__(self, task_manager: TaskManager):
+        self.task_manager = task_manager
+        self.session = SessionLocal()
+        self.output_dir = task_manager.output_dir
+        self.wakeup = asyncio.Event()
+
+    async def create_plan(
+        self,
+        start_date: str,
+        end_date: str,
+        country_codes: str,
+        output_format: str,
+    ) -> int:
+        """Create a plan and its queued tasks, returns the plan id"""
+        dates = expand_dates(start_date, end_date)
+        codes = parse_country_codes(country_codes)
+        if output_format not in available_formats():
+            raise ValueError(f"Unsupported output format: {output_format}")
+
+        def add(session):
+            plan = CrawlPlanDB(
+                start_date=start_date,
+                end_date=end_date,
+                country_codes=",".join(codes),
+                output_format=output_format,
+                created_at=datetime.now(),
+            )
+            session.add(plan)
+            session.flush()
+            plan_dir = os.path.join(self.output_dir, f"plan_{plan.id}")
+            os.makedirs(plan_dir, exist_ok=True)
+            for date in dates:
+                for code in codes:
+                    path = output_path(plan_dir, date, output_format, code)
+                    create_output(path, output_format)
+                    session.add(
+                        TaskDB(
+                            date=date,
+                            country_code=code,
+                            plan_id=plan.id,
+                            queued=True,
+                            stop_flag=True,
+                            done=False,
+                            created_at=datetime.now(),
+                            output_format=output_format,
+                            data_file_path=path,
+                        )
+                    )
+            return plan.id
+
+        plan_id = await db_writer.run(add)
+        logger.info(
+            f"Crawl plan {plan_id}: {len(dates)} days x {len(codes)} countries queued"
+        )
+        self.wakeup.set()
+        return plan_id
+
+    async def stop_plan(self, plan_id: int) -> bool:
+        """Stop the running tasks of a plan, queued ones stay queued"""
+
+        def stop(session):
+            return (
+                session.query(CrawlPlanDB)
+                .filter(CrawlPlanDB.id == plan_id)
+                .update({"stop_flag": True})
+            )
+
+        if not await db_writer.run(stop):
+            return False
+        for task_id in self._running_tasks(plan_id):
+            await self.task_manager.stop_task(task_id)
+        return True
+
+    async def start_plan(self, plan_id: int) -> bool:
+        """Queue every unfinished task of a plan again, including failed ones"""
+        running = self._running_tasks(plan_id)
+
+        def start(session):
+            updated = (
+                session.query(CrawlPlanDB)
+                .filter(CrawlPlanDB.id == plan_id)
+                .update({"stop_flag": False})
+            )
+            session.query(TaskDB).filter(
+                TaskDB.plan_id == plan_id,
+                TaskDB.done == False,
+                TaskDB.id.notin_(running),
+            ).update({"queued": True, "error": None}, synchronize_session=False)
+            return updated
+
+        if not await db_writer.run(start):
+            return False
+        self.wakeup.set()
+        return True
+
+    async def set_max_running_tasks(self, max_running_tasks: int) -> bool:
+        """Change the cap for every process, the leader worker's planner included"""
+        if max_running_tasks <= 0:
+            return False
+        planner_config.max_running_tasks = max_running_tasks
+        await save_setting("max_running_tasks", {"value": max_running_tasks})
+        self.wakeup.set()
+        return True
+
+    def apply_settings(self, settings: Dict[str, dict]):
+        """Take the cap another process stored"""
+        stored = settings.get("max_running_tasks")
+        if stored and stored["value"] != planner_config.max_running_tasks:
+            logger.info(f"Max running tasks changed to {stored['value']}")
+            planner_config.max_running_tasks = stored["value"]
+            self.wakeup.set()
+
+    def _running_tasks(self, plan_id: int) -> List[int]:
+        task_ids = TaskManager.running_ids()
+        if not task_ids:
+            return []
+        rows = (
+            self.session.query(TaskDB.id)
+            .filter(TaskDB.plan_id == plan_id, TaskDB.id.in_(task_ids))
+            .all()
+        )
+        return [row.id for row in rows]
+
+    def get_plans(self) -> List[dict]:
+        """Every plan with the aggregate progress of its tasks, newest first"""
+        plans = (
+            self.session.query(CrawlPlanDB)
+            .order_by(CrawlPlanDB.created_at.desc())
+            .populate_existing()
+            .all()
+        )
+        progress = {
+            row.plan_id: row
+            for row in self.session.query(
+                TaskDB.plan_id,
+                func.count(TaskDB.id).label("tasks"),
+                func.sum(case((TaskDB.done == True, 1), else_=0)).label("done"),
+                func.sum(case((TaskDB.queued == True, 1), else_=0)).label("queued"),
+                func.sum(case((TaskDB.error != None, 1), else_=0)).label("failed"),
+                func.sum(TaskDB.current_page).label("current_pages"),
+                func.sum(TaskDB.total_page).label("total_pages"),
+            )
+            .filter(TaskDB.plan_id != None)
+            .group_by(TaskDB.plan_id)
+            .all()
+        }
+        result = []
+        for plan in plans:
+            row = progress.get(plan.id)
+            result.append(
+                {
+                    "plan": plan,
+                    "tasks": row.tasks if row else 0,
+                    "done": row.done if row else 0,
+                    "queued": row.queued if row else 0,
+                    "failed": row.failed if row else 0,
+                    "running": len(self._running_tasks(plan.id)),
+                    "current_pages": row.current_pages if row else 0,
+                    "total_pages": row.total_pages if row else 0,
+                }
+            )
+        return result
+
+    async def schedule(self) -> int:
+        """One scheduling round, returns how many tasks it started"""
+        slots = planner_config.max_running_tasks - TaskManager.running_count()
+        if slots <= 0:
+            return 0
+        tasks = (
+            self.session.query(TaskDB.id)
+            .join(CrawlPlanDB, TaskDB.plan_id == CrawlPlanDB.id)
+            .filter(TaskDB.queued == True, CrawlPlanDB.stop_flag == False)
+            .order_by(TaskDB.plan_id, TaskDB.date, TaskDB.country_code)
+            .limit(slots)
+            .all()
+        )
+        started = 0
+        for task in tasks:
+            if not await self.task_manager.start_task(task.id):
+                continue
+            # a finished task frees a slot, start the next one right away; a
+            # task run by a worker process is noticed on the next round
+            future = TaskManager.running.get(task.id)
+            if future is not None:
+                future.add_done_callback(lambda _: self.wakeup.set())
+            started += 1
+        return started
+
+    async def run(self):
+        """Scheduling loop, started with the application"""
+        logger.info(
+            f"Crawl planner started, max {planner_config.max_running_tasks} running tasks"
+        )
+        while True:
+            self.wakeup.clear()
+            try:
+                # queued writes first, so a round sees the latest task rows
+                await db_writer.flush()
+                await self.schedule()
+            except Exception as e:
+                logger.error(f"Error in crawl planner: {str(e)}")
+            try:
+                await asyncio.wait_for(
+                    self.wakeup.wait(), timeout=planner_config.interval
+                )
+            except asyncio.TimeoutError:
+                pass
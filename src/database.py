@@ -1,14 +1,38 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime
+from sqlalchemy import (
+    create_engine,
+    event,
+    inspect,
+    text,
+    Column,
+    Integer,
+    String,
+    Boolean,
+    DateTime,
+)
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
 DATABASE_URL = "sqlite:///spider.db"
-engine = create_engine(DATABASE_URL)
+DEFAULT_COUNTRY_CODE = "0055"
+# writes happen on the db_writer thread, reads on the event loop thread
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
 
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets page loads read while the spider writes, the rest trades fsyncs for speed"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-16000")
+    cursor.close()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -27,6 +51,73 @@ class TaskDB(Base):
     stop_flag = Column(Boolean, default=False)
     done = Column(Boolean, default=False)
     data_file_path = Column(String, nullable=True)
+    output_format = Column(String, default="csv", server_default="csv")
+    error = Column(String, nullable=True)  # why the task was stopped, if it failed
+    country_code = Column(
+        String, default=DEFAULT_COUNTRY_CODE, server_default=DEFAULT_COUNTRY_CODE
+    )
+    plan_id = Column(Integer, nullable=True, index=True)  # the crawl plan it is part of
+    queued = Column(Boolean, default=False, server_default="0")  # waits for the planner
+    # incremental crawls: the task whose output this one continues, and the
+    # newest record time in the output with the ids stored at that time
+    base_task_id = Column(Integer, nullable=True)
+    watermark_time = Column(String, nullable=True)
+    watermark_ids = Column(String, nullable=True)
+    # records in the output, duplicate records dropped while writing it, and
+    # the record count upstream reported on the last page committed
+    rows = Column(Integer, default=0, server_default="0")
+    duplicates = Column(Integer, default=0, server_default="0")
+    expected_rows = Column(Integer, nullable=True)
+    # worker mode: the worker process running the task and until when, a
+    # task whose lease ran out is claimed by another worker
+    lease_owner = Column(String, nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+
+class CrawlPlanDB(Base):
+    """A date range times a list of countries, crawled as one task per pair"""
+
+    __tablename__ = "crawl_plans"
+
+    id = Column(Integer, primary_key=True)
+    start_date = Column(String, nullable=False)
+    end_date = Column(String, nullable=False)
+    country_codes = Column(String, nullable=False)  # comma separated
+    output_format = Column(String, default="csv")
+    stop_flag = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class LeaseDB(Base):
+    """A named role held by one process until expires_at, e.g. the leader worker"""
+
+    __tablename__ = "leases"
+
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    state = Column(String, nullable=True)  # JSON the holder reports, e.g. its pacing
+
+
+class SettingDB(Base):
+    """A setting changed in the web app, every process applies it (JSON value)"""
+
+    __tablename__ = "settings"
+
+    name = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+
+class TaskCheckpointDB(Base):
+    __tablename__ = "task_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, nullable=False, index=True)
+    page = Column(Integer, nullable=False)  # pages durable in the output
+    offset = Column(Integer, nullable=False)  # output size at that point
+    rows = Column(Integer, nullable=False, default=0)
+    duplicates = Column(Integer, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.now)
 
 
@@ -38,10 +129,33 @@ class AccountDB(Base):
     token = Column(String, nullable=True)
     is_online = Column(Boolean, default=False, server_default="0")
     is_active = Column(Boolean, default=True, server_default="1")
+    token_issued_at = Column(DateTime, nullable=True)  # when the token was issued
+    last_ok_at = Column(DateTime, nullable=True)  # last request the token passed
+
+
+def migrate_db():
+    """Add columns introduced after a table was first created, create_all skips them"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                conn.execute(text(ddl))
+            # indexes of the added columns, existing ones are skipped
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    migrate_db()
 
 
 # Create tables at module import
@@ -0,0 +1,130 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, TypeVar
+
+from database import Base, SessionLocal, TaskDB, TaskCheckpointDB, AccountDB
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+class DatabaseWriter:
+    """
+    Database write path that keeps commits off the event loop.
+
+    Every write runs on one dedicated thread with its own session, so SQLite
+    sees a single writer and the loop serving FastAPI never blocks on a
+    commit. Progress updates are coalesced per row and flushed every
+    flush_interval seconds, so a spider writing a page a second costs one
+    small transaction per interval instead of one per page.
+    """
+
+    def __init__(self, flush_interval: float = 2.0):
+        self.flush_interval = flush_interval
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="db-writer"
+        )
+        self.pending_tasks: Dict[int, dict] = {}
+        self.pending_accounts: Dict[str, dict] = {}
+        self.pending_rows: List[Base] = []
+        self.flusher: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def _run(fn: Callable[..., T]) -> T:
+        session = SessionLocal()
+        try:
+            result = fn(session)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    async def run(self, fn: Callable[..., T]) -> T:
+        """Run fn(session) on the writer thread and commit, without blocking the loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run, fn)
+
+    def update_task(self, task_id: int, **fields):
+        """Queue a coalesced update of a TaskDB row, the last value of a field wins"""
+        self.pending_tasks.setdefault(task_id, {}).update(fields)
+        self._ensure_flusher()
+
+    def update_account(self, username: str, **fields):
+        """Queue a coalesced update of an AccountDB row"""
+        self.pending_accounts.setdefault(username, {}).update(fields)
+        self._ensure_flusher()
+
+    def add(self, row: Base):
+        """Queue a new row, it is inserted in the same transaction as the updates"""
+        self.pending_rows.append(row)
+        self._ensure_flusher()
+
+    def discard_task(self, task_id: int):
+        """Drop the queued writes of a task another process has taken over"""
+        self.pending_tasks.pop(task_id, None)
+        self.pending_rows = [
+            row
+            for row in self.pending_rows
+            if not (isinstance(row, TaskCheckpointDB) and row.task_id == task_id)
+        ]
+
+    def _ensure_flusher(self):
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self.pending_tasks or self.pending_accounts or self.pending_rows:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing database updates: {str(e)}")
+
+    async def flush(self):
+        """Write every queued update now"""
+        tasks, self.pending_tasks = self.pending_tasks, {}
+        accounts, self.pending_accounts = self.pending_accounts, {}
+        rows, self.pending_rows = self.pending_rows, []
+        if not tasks and not accounts and not rows:
+            return
+
+        def apply(session):
+            for task_id, fields in tasks.items():
+                session.query(TaskDB).filter(TaskDB.id == task_id).update(fields)
+            for username, fields in accounts.items():
+                session.query(AccountDB).filter(AccountDB.username == username).update(
+                    fields
+                )
+            session.add_all(rows)
+
+        try:
+            await self.run(apply)
+        except Exception:
+            # put the updates back under anything queued meanwhile, retry next flush
+            for task_id, fields in tasks.items():
+                self.pending_tasks[task_id] = {
+                    **fields,
+                    **self.pending_tasks.get(task_id, {}),
+                }
+            for username, fields in accounts.items():
+                self.pending_accounts[username] = {
+                    **fields,
+                    **self.pending_accounts.get(username, {}),
+                }
+            self.pending_rows = rows + self.pending_rows
+            raise
+
+    async def close(self):
+        """Flush what is queued and stop the writer thread, on shutdown"""
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
+
+db_writer = DatabaseWriter()
@@ -0,0 +1,60 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+from typing import Iterable, List
+
+
+def id_key(record_id) -> int:
+    """64-bit hash of a record id, collisions are negligible at a day's volume"""
+    digest = hashlib.blake2b(str(record_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class SeenIds:
+    """
+    Ids of the records already in one output, 8 bytes per id.
+
+    Keys live in a sorted array searched by bisection; new keys go to a small
+    set first and are merged into the array in bulk, so adding stays cheap.
+    The output itself is the durable copy: the index is rebuilt from it when
+    a task starts, so it always matches what is on disk after a rewind.
+    """
+
+    def __init__(self, merge_at: int = 65536):
+        self.sorted = array("Q")
+        self.recent = set()
+        self.merge_at = merge_at
+
+    @classmethod
+    def from_ids(cls, record_ids: Iterable) -> "SeenIds":
+        seen = cls()
+        seen.sorted = array(
+            "Q", sorted({id_key(record_id) for record_id in record_ids})
+        )
+        return seen
+
+    def __len__(self) -> int:
+        return len(self.sorted) + len(self.recent)
+
+    def _contains(self, key: int) -> bool:
+        if key in self.recent:
+            return True
+        index = bisect_left(self.sorted, key)
+        return index < len(self.sorted) and self.sorted[index] == key
+
+    def _merge(self):
+        self.sorted = array("Q", sorted([*self.sorted, *self.recent]))
+        self.recent = set()
+
+    def keep_new(self, batch: List[dict]) -> List[dict]:
+        """The records of batch not seen before, which are marked seen"""
+        fresh = []
+        for record in batch:
+            key = id_key(record.get("id"))
+            if self._contains(key):
+                continue
+            self.recent.add(key)
+            fresh.append(record)
+        if len(self.recent) >= self.merge_at:
+            self._merge()
+        return fresh
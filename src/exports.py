@@ -0,0 +1,238 @@
+import asyncio
+import csv
+import io
+import os
+import zlib
+from email.utils import formatdate
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from database import SessionLocal, TaskDB
+from output_formats import (
+    LEGACY_CSV_COLUMNS,
+    RECORD_COLUMNS,
+    iter_output_rows,
+)
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _load_tasks(
+    task_ids: Optional[List[int]],
+    start_date: Optional[str],
+    end_date: Optional[str],
+    country_code: Optional[str],
+) -> List[TaskDB]:
+    with SessionLocal() as session:
+        query = session.query(TaskDB)
+        if task_ids is not None:
+            tasks = query.filter(TaskDB.id.in_(task_ids)).all()
+            order = {task_id: n for n, task_id in enumerate(task_ids)}
+            tasks.sort(key=lambda task: order[task.id])
+        else:
+            # the newest finished crawl of each day, an incremental one
+            # already holds the records of the crawl it continues
+            tasks = {}
+            for task in (
+                query.filter(
+                    TaskDB.date >= start_date,
+                    TaskDB.date <= end_date,
+                    TaskDB.country_code == country_code,
+                    TaskDB.done == True,
+                )
+                .order_by(TaskDB.date, TaskDB.id)
+                .all()
+            ):
+                tasks[task.date] = task
+            tasks = list(tasks.values())
+        session.expunge_all()
+    return tasks
+
+
+async def load_tasks(
+    task_ids: Optional[List[int]] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    country_code: Optional[str] = None,
+) -> List[TaskDB]:
+    """Tasks by id in that order, or the newest finished task of each day in a range"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _load_tasks, task_ids, start_date, end_date, country_code
+    )
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    The first and last byte of a single range Range header, None when the
+    whole file should be sent (no byte range, several ranges or a malformed
+    header). Raises ValueError when the range lies outside the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(f"Range {header} not satisfiable for {size} bytes")
+    return start, min(end, size - 1)
+
+
+def accepts_gzip(request: Request) -> bool:
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+def iter_file(
+    path: str, start: int, length: int, chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """length bytes of a file from start, a file that is still growing is cut there"""
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def iter_gzip(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Compress a stream of bytes into one gzip stream as it goes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _attachment(filename: str) -> str:
+    return f'attachment; filename="{filename}"'
+
+
+def file_response(
+    request: Request, path: str, filename: str, media_type: str
+) -> Response:
+    """
+    Send a file output in chunks read on the thread pool.
+
+    A Range request gets the bytes asked for (206), so interrupted downloads
+    resume; otherwise a plain CSV is gzip encoded on the fly when the client
+    accepts it. If-Range is checked against the ETag, which changes while a
+    running task appends, so a resume never mixes two versions of a file.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {
+        "Content-Disposition": _attachment(filename),
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified,
+    }
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range in (None, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{size}"}
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                iter_file(path, start, end - start + 1),
+                status_code=206,
+                media_type=media_type,
+                headers=headers,
+            )
+    if media_type == "text/csv" and accepts_gzip(request):
+        return gzip_response(iter_file(path, 0, size), filename, media_type, etag)
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(
+        iter_file(path, 0, size), media_type=media_type, headers=headers
+    )
+
+
+def gzip_response(
+    chunks: Iterable[bytes],
+    filename: str,
+    media_type: str,
+    etag: Optional[str] = None,
+) -> StreamingResponse:
+    """Stream chunks with Content-Encoding gzip, the client stores them decoded"""
+    headers = {
+        "Content-Disposition": _attachment(filename),
+        "Content-Encoding": "gzip",
+        "Vary": "Accept-Encoding",
+    }
+    if etag:
+        # the encoded bytes are another representation with its own tag
+        headers["ETag"] = etag[:-1] + '-gzip"'
+    return StreamingResponse(iter_gzip(chunks), media_type=media_type, headers=headers)
+
+
+def export_columns(tasks: List[TaskDB]) -> List[str]:
+    """Columns of a merged export, the legacy ones as soon as one task has only those"""
+    if any((task.output_format or "csv") == "csv" for task in tasks):
+        return LEGACY_CSV_COLUMNS
+    return RECORD_COLUMNS
+
+
+def iter_merged_csv(
+    tasks: List[TaskDB], chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    The outputs of several finished tasks as one CSV, in the order given.
+
+    Plain CSV outputs are copied byte for byte and the export keeps their
+    headerless legacy columns; otherwise every field is written after a
+    header row. Records are converted a batch at a time, so the export never
+    exists in memory or on disk as a whole.
+    """
+    columns = export_columns(tasks)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if columns is RECORD_COLUMNS:
+        writer.writerow(columns)
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    for task in tasks:
+        output_format = task.output_format or "csv"
+        logger.info(f"Exporting task {task.id} ({task.date}, {output_format})")
+        if output_format == "csv":
+            yield drain()
+            yield from iter_file(
+                task.data_file_path, 0, os.path.getsize(task.data_file_path)
+            )
+            continue
+        for row in iter_output_rows(task.data_file_path, output_format, columns):
+            writer.writerow(row)
+            if buffer.tell() >= chunk_size:
+                yield drain()
+    yield drain()
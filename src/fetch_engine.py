@@ -0,0 +1,648 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from account_pool import PooledAccount, account_pool
+from database import DEFAULT_COUNTRY_CODE, TaskDB, TaskCheckpointDB, SessionLocal
+from db_writer import db_writer
+from dedupe import SeenIds
+from http_client import http_client, antgst_url
+from ingest import CHUNK_SIZE, PageSpool, ResponseBody, page_decoder
+from login_coordinator import login_coordinator
+from metrics import spider_output_bytes, spider_pages, spider_rows
+from output_formats import (
+    OutputSink,
+    open_sink,
+    output_size,
+    read_output_ids,
+    rewind_output,
+)
+from rate_controller import RateController
+from record_store import record_store
+from retry_policy import (
+    OK,
+    AUTH,
+    THROTTLE,
+    RetryExhausted,
+    RetryPolicy,
+    classify,
+    spider_retry_policy,
+)
+from task_events import task_progress, task_status
+from utils.logger_config import get_logger
+from watermark import Watermark
+
+logger = get_logger(__name__)
+
+SEND_RECORD_LIST_URL = antgst_url("/sms/otpPremium/channel/sendRecordList")
+RECORD_FIELDS = "id,,userName,countryName,operator,smsFrom,smsTo,message,sendResult,gatewayDr,gatewayRealDr,intervalTime,smsCount,smsFee,currency,sendDrStatus,resendDrTimes,sendTime,updateTime,gatewayName,gatewayResult,validateResult,action,createTime"
+PAGE_SIZE = 3000
+
+
+class LeaseLost(Exception):
+    """Another worker took over the task, this run must not touch its output"""
+
+
+class FetchedPage:
+    """One page staged on disk, waiting for its turn in the output"""
+
+    def __init__(
+        self,
+        spool: PageSpool,
+        pages: int,
+        total: Optional[int],
+        newest: Watermark,
+        reached: bool,
+        latency: float = 0.0,
+    ):
+        self.spool = spool
+        self.pages = pages  # result.pages of the response
+        self.total = total  # result.total, the records upstream has for the day
+        self.newest = newest  # watermark of the records on this page
+        self.reached = reached  # held records an incremental crawl has already
+        self.latency = latency  # seconds spent waiting for upstream, what pacing sees
+        self.account: Optional[str] = None  # who fetched it
+
+
+class PageFetchEngine:
+    """
+    Fetch the pages of one task concurrently, one worker per online account.
+
+    Workers take accounts from the in-memory account pool, least recently used
+    first, and give each back with the cooldown the rate controller sets for
+    it, so every account stays under the upstream throttle on its own budget.
+    Tasks running at the same time split the online accounts between their
+    workers, so together they never run more workers than there are accounts.
+
+    Pages are handed out in ascending order and fetched out of order, but they
+    are written and committed strictly in order through a small reorder buffer,
+    so TaskDB.current_page is always the first page not yet on disk and a
+    stopped or crashed task resumes from it.
+
+    The task row is read once and then tracked in memory; progress goes to the
+    database through the coalescing db_writer, so the loop never waits on a
+    commit. After each page the sink is made durable and a TaskCheckpointDB row
+    records the output offset; a new run resumes from the last checkpoint and
+    cuts the output back to it, so a page is never appended twice. A worker
+    that loses the task's lease abandons the run: the pages in flight are
+    dropped and neither the output nor the task row is written again.
+
+    An incremental task (base_task_id set) starts from a copy of the output of
+    the last complete crawl of its date and country, drops the records at or
+    below that crawl's watermark and stops at the first page that holds any.
+
+    The loop only moves bytes: response bodies are decoded and their records
+    pickled on the ingest pool (page_decoder), and pages are appended to the
+    output and checkpointed on a thread of the engine by one committer task,
+    so a task with many pages in flight does not stall the other coroutines.
+
+    Records shift between pages while new ones arrive, so the same record can
+    come back on two pages. The ids already in the output are indexed when a
+    run starts (SeenIds) and a record is only written the first time its id
+    is seen; dropped records are counted as duplicates, and the count
+    upstream reports against the rows written shows the records missed.
+
+    Failed pages go back in the queue after the backoff of their error class.
+    An auth error swaps the account; once a page exhausts the retry budget of
+    a class the task is stopped with the error instead of spinning forever.
+    """
+
+    running: List["PageFetchEngine"] = []  # engines of this process
+
+    def __init__(
+        self,
+        task_id: int,
+        pacing: RateController,
+        rescan_interval: int = 60,
+        stop_poll_interval: float = 2,
+        retry_policy: RetryPolicy = spider_retry_policy,
+    ):
+        self.task_id = task_id
+        self.pacing = pacing
+        self.retry_policy = retry_policy
+        self.rescan_interval = rescan_interval
+        self.stop_poll_interval = stop_poll_interval
+        self.session = SessionLocal()
+        self.task: Optional[TaskDB] = None
+        self.stop_flag = False
+        self.lease_lost = False
+        self.stop_checked_at = 0.0
+        self.next_page = 0
+        self.retry_pages: Dict[int, float] = {}  # page -> when it may be retried
+        self.failures: Dict[int, Dict[str, int]] = {}  # page -> error class counts
+        self.last_error: Optional[str] = None
+        self.completed: Dict[int, FetchedPage] = {}
+        self.watermark = Watermark()  # newest record written, moves with the output
+        self.since: Optional[Watermark] = None  # incremental: what is stored already
+        self.boundary: Optional[int] = None  # first page holding stored records
+        self.sink: Optional[OutputSink] = None
+        self.seen = SeenIds()  # ids in the output
+        self.duplicates = 0
+        self.rows = 0  # in the output
+        self.output_bytes = 0  # size of the output at the last checkpoint
+        self.expected_rows: Optional[int] = None
+        self.advanced = asyncio.Event()
+        self.total_known = False
+        self.workers: List[asyncio.Future] = []
+        # the sink, seen and the record store hand-over only run on this thread
+        self.output = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"output-{task_id}"
+        )
+        self.committer: Optional[asyncio.Future] = None
+
+    def abandon(self):
+        """The task lease is gone: drop the pages in flight and write nothing more"""
+        self.lease_lost = True
+
+    def _stopped(self) -> bool:
+        now = time.monotonic()
+        if not self.stop_flag and now - self.stop_checked_at >= self.stop_poll_interval:
+            self.stop_checked_at = now
+            self.stop_flag = bool(
+                self.session.query(TaskDB.stop_flag)
+                .filter(TaskDB.id == self.task_id)
+                .scalar()
+            )
+            # end the read transaction so it does not pin an old WAL snapshot
+            self.session.rollback()
+        return self.stop_flag
+
+    def _finished(self) -> bool:
+        return self._stopped() or self.task.current_page >= self.task.total_page
+
+    def _share(self) -> int:
+        """Workers this task may run, the running tasks split the online accounts"""
+        online = account_pool.online_count()
+        return -(-online // len(PageFetchEngine.running or [self]))
+
+    def _alive(self) -> int:
+        return sum(1 for worker in self.workers if not worker.done())
+
+    def _over_share(self) -> bool:
+        """Another task started, this worker stops after its page"""
+        return self._alive() > self._share()
+
+    def _worker_target(self) -> int:
+        """How many workers to keep, never more than the accounts the others leave"""
+        online = account_pool.online_count()
+        busy = sum(
+            engine._alive() for engine in PageFetchEngine.running if engine is not self
+        )
+        return max(0, min(self._share(), online - busy))
+
+    def _window(self) -> int:
+        """How far ahead of current_page pages may be handed out"""
+        return max(4, 2 * len(self.workers))
+
+    async def _claim_page(self) -> Optional[int]:
+        """Hand out the next page to fetch, or None when there is nothing left"""
+        while not self._finished():
+            now = time.monotonic()
+            ready = [page for page, at in self.retry_pages.items() if at <= now]
+            if ready:
+                page = min(ready)
+                del self.retry_pages[page]
+                return page
+            # until the first response tells us the real page count only
+            # fetch the head page, the default total_page is a placeholder
+            limit = (
+                self.task.total_page if self.total_known else self.task.current_page + 1
+            )
+            if self.boundary is not None:
+                limit = min(limit, self.boundary + 1)
+            in_window = self.next_page - self.task.current_page < self._window()
+            if self.next_page < limit and in_window:
+                page = self.next_page
+                self.next_page += 1
+                return page
+            # wait for the pages in flight or the next backoff to run out
+            timeout = self.rescan_interval
+            if self.retry_pages:
+                timeout = min(timeout, min(self.retry_pages.values()) - now)
+            self.advanced.clear()
+            try:
+                await asyncio.wait_for(self.advanced.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+    async def _fetch_page(
+        self, account: PooledAccount, page: int
+    ) -> Tuple[str, str, Optional[FetchedPage]]:
+        """Returns (error class, detail, the page when it was fetched)"""
+        params = {
+            "_t": int(time.time() * 1000),
+            "day": self.task.date,
+            "countryCode": self.task.country_code or DEFAULT_COUNTRY_CODE,
+            "column": "createTime",
+            "order": "desc",
+            "field": RECORD_FIELDS,
+            "pageNo": page,
+            "pageSize": PAGE_SIZE,
+        }
+        headers = {"X-Access-Token": str(account.token)}
+        client = http_client.get_session()
+        started = time.monotonic()
+        async with client.get(
+            SEND_RECORD_LIST_URL, params=params, headers=headers
+        ) as response:
+            if response.status != 200:
+                return (
+                    classify(status=response.status),
+                    f"status {response.status}",
+                    None,
+                )
+            # the loop only moves bytes, big bodies straight to a temp file;
+            # records are decoded and staged on the ingest pool
+            body = ResponseBody()
+            writing = 0.0  # spent on our disk, not waiting for upstream
+            try:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    written = time.monotonic()
+                    body.write(chunk)
+                    writing += time.monotonic() - written
+            except BaseException:
+                body.discard()
+                raise
+            charset = response.charset
+        # pacing sees the network only, not the body writes or the decode on
+        # the ingest pool
+        latency = time.monotonic() - started - writing
+        envelope, spool, newest, reached = await page_decoder.decode(
+            body.handover(), charset, self.since
+        )
+        del body
+        error_class = classify(payload=envelope)
+        if error_class != OK:
+            spool.close()
+            return error_class, str(envelope.get("message", "")), None
+        result = envelope.get("result") or {}
+        return (
+            OK,
+            "",
+            FetchedPage(
+                spool,
+                result.get("pages", 0),
+                result.get("total"),
+                newest,
+                reached,
+                latency,
+            ),
+        )
+
+    def _commit_ready(self):
+        """Start the committer unless it is running, it picks up the new page"""
+        if self.committer is None or self.committer.done():
+            self.committer = asyncio.ensure_future(self._commit_pages())
+
+    async def _on_output(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.output, func, *args
+        )
+
+    def _write_page(self, fetched: FetchedPage, page: int) -> Tuple[int, tuple]:
+        """Output thread: append a page and checkpoint after it"""
+        rows = self.sink.rows
+        try:
+            if self.lease_lost:
+                raise LeaseLost()
+            self.sink.write_spool(fetched.spool, keep=self._keep_new)
+        finally:
+            fetched.spool.close()
+        if self.lease_lost:
+            raise LeaseLost()
+        return self.sink.rows - rows, self._sync_output(page)
+
+    def _sync_output(self, page: int, final: bool = False) -> tuple:
+        """Output thread: (offset, rows, size) of a checkpoint, offset None if none"""
+        offset = self.sink.checkpoint(page, final)
+        if offset is None:
+            return None, self.sink.rows, 0
+        return offset, self.sink.rows, output_size(self.sink.path)
+
+    async def _commit_pages(self):
+        """Write every buffered page that continues the on-disk prefix"""
+        while self.task.current_page in self.completed:
+            page = self.task.current_page
+            fetched = self.completed.pop(page)
+            written, synced = await self._on_output(self._write_page, fetched, page + 1)
+            self.duplicates += fetched.spool.rows - written
+            spider_pages.inc()
+            spider_rows.inc(written)
+            self.task.current_page += 1
+            # the pages after one holding stored records are all stored already
+            self.task.total_page = page + 1 if fetched.reached else fetched.pages
+            self.total_known = True
+            self.rows = synced[1]
+            fields = {"rows": self.rows, "duplicates": self.duplicates}
+            if fetched.total is not None:
+                self.expected_rows = fields["expected_rows"] = fetched.total
+            if self.watermark.merge(fetched.newest):
+                fields.update(self.watermark.fields())
+            db_writer.update_task(
+                self.task_id,
+                current_page=self.task.current_page,
+                total_page=self.task.total_page,
+                **fields,
+            )
+            self._checkpoint(*synced)
+            self._publish(account=fetched.account)
+            logger.info(f"Task {self.task_id} completed page {self.task.current_page}")
+        # pages past the real end were fetched on the placeholder total, drop them
+        for page in [p for p in self.completed if p >= self.task.total_page]:
+            self.completed.pop(page).spool.close()
+        self.advanced.set()
+
+    def _publish(self, **fields):
+        task_progress.publish(
+            self.task_id,
+            current_page=self.task.current_page,
+            total_page=self.task.total_page,
+            rows=self.rows,
+            duplicates=self.duplicates,
+            expected_rows=self.expected_rows,
+            status=task_status(self.task),
+            error=self.task.error,
+            last_error=self.last_error,
+            **fields,
+        )
+
+    def _keep_new(self, batch: List[dict]) -> List[dict]:
+        batch = self.seen.keep_new(batch)
+        if record_store.enabled:
+            record_store.add(
+                self.task_id,
+                self.task.date,
+                self.task.country_code or DEFAULT_COUNTRY_CODE,
+                batch,
+            )
+        return batch
+
+    def _checkpoint(self, offset: Optional[int], rows: int, size: int):
+        if offset is not None:
+            db_writer.add(
+                TaskCheckpointDB(
+                    task_id=self.task_id,
+                    page=self.task.current_page,
+                    offset=offset,
+                    rows=rows,
+                    duplicates=self.duplicates,
+                )
+            )
+            spider_output_bytes.inc(max(0, size - self.output_bytes))
+            self.output_bytes = size
+
+    def _finish_output(self, page: int) -> tuple:
+        try:
+            return self._sync_output(page, final=True)
+        finally:
+            self.sink.close()
+
+    async def _close_sink(self):
+        # every page written so far is whole, so the end of a run is a checkpoint
+        try:
+            self._checkpoint(
+                *await self._on_output(self._finish_output, self.task.current_page)
+            )
+        finally:
+            self.sink = None
+
+    async def _abandon_output(self):
+        # the new owner resumes from the last checkpoint that reached the database
+        db_writer.discard_task(self.task_id)
+        try:
+            if self.sink is not None:
+                await self._on_output(self.sink.abandon)
+        finally:
+            self.sink = None
+
+    def _part_prefix(self) -> str:
+        # an incremental task shares its directory output with the copied parts
+        return f"t{self.task_id}-" if self.task.base_task_id else ""
+
+    def _resume(self) -> int:
+        """Cut the output back to the last checkpoint, returns the rows kept"""
+        checkpoint = (
+            self.session.query(TaskCheckpointDB)
+            .filter(TaskCheckpointDB.task_id == self.task_id)
+            .order_by(TaskCheckpointDB.page.desc(), TaskCheckpointDB.id.desc())
+            .first()
+        )
+        output_format = self.task.output_format or "csv"
+        if checkpoint is None:
+            if self.task.current_page > 0:
+                # progress from before checkpoints existed, trust it as it is
+                return 0
+            rewind_output(
+                self.task.data_file_path, output_format, 0, 0, self._part_prefix()
+            )
+            # marks the task as checkpointed even if the format (parquet) does
+            # not reach a checkpoint of its own before the next crash
+            db_writer.add(
+                TaskCheckpointDB(task_id=self.task_id, page=0, offset=0, rows=0)
+            )
+            return 0
+        rewind_output(
+            self.task.data_file_path,
+            output_format,
+            checkpoint.page,
+            checkpoint.offset,
+            self._part_prefix(),
+        )
+        self.duplicates = checkpoint.duplicates or 0
+        if checkpoint.page != self.task.current_page:
+            logger.info(
+                f"Task {self.task_id} resumes from checkpoint at page {checkpoint.page}"
+            )
+            self.task.current_page = checkpoint.page
+            db_writer.update_task(self.task_id, current_page=checkpoint.page)
+        return checkpoint.rows
+
+    def _set_offline(self, account: PooledAccount):
+        account_pool.set_offline(account.username)
+        db_writer.update_account(account.username, is_online=False)
+
+    def _retry_later(self, page: int, error_class: str, detail: str) -> float:
+        """Queue a failed page after its backoff, returns the backoff"""
+        counts = self.failures.setdefault(page, {})
+        counts[error_class] = counts.get(error_class, 0) + 1
+        attempt = counts[error_class]
+        self.last_error = f"page {page}: {error_class} {detail}".strip()
+        if not self.retry_policy.should_retry(error_class, attempt):
+            raise RetryExhausted(error_class, sum(counts.values()), self.last_error)
+        delay = self.retry_policy.delay(error_class, attempt)
+        self.retry_pages[page] = time.monotonic() + delay
+        self.advanced.set()
+        return delay
+
+    async def _worker(self):
+        while not self._over_share():
+            # take the account first, a claimed page never waits on a cooldown
+            account = await account_pool.acquire()
+            if account is None:
+                break  # no account online, run() reports it
+            page = await self._claim_page()
+            if page is None:
+                account_pool.release(account, 0)
+                break
+            username = account.username
+            token = account.token
+            # a cancelled or failed worker hands the account back right away
+            cooldown = 0.0
+            try:
+                try:
+                    error_class, detail, fetched = await self._fetch_page(account, page)
+                except Exception as e:
+                    error_class, detail, fetched = classify(error=e), str(e), None
+
+                if error_class == AUTH and account.token != token:
+                    # renewed while the request was out, the new token is fine
+                    self.retry_pages[page] = 0
+                    self.advanced.set()
+                    continue
+                if error_class == AUTH:
+                    # swap the account, the page goes straight to the next one
+                    login_coordinator.token_expired(username)
+                    self._set_offline(account)
+                    login_coordinator.renew_soon(username)
+                    logger.error(
+                        f"Auth failed ({detail}), account {username} set offline, "
+                        f"logging in again"
+                    )
+                    self._retry_later(page, error_class, detail)
+                    continue
+                if error_class != OK:
+                    # paced before _retry_later, which raises once the budget is spent
+                    cooldown = self.pacing.record_failure(username, error_class)
+                    backoff = self._retry_later(page, error_class, detail)
+                    if error_class == THROTTLE:
+                        cooldown = max(cooldown, backoff)
+                    logger.error(
+                        f"Page {page} failed with {username}: {error_class} {detail}, "
+                        f"retry in {backoff:.1f}s"
+                    )
+                    continue
+
+                cooldown = self.pacing.record_success(username, fetched.latency)
+                account_pool.mark_ok(username)
+            finally:
+                account_pool.release(account, cooldown)
+            self.failures.pop(page, None)
+            if fetched.reached and (self.boundary is None or page < self.boundary):
+                self.boundary = page
+            fetched.account = username
+            self.completed[page] = fetched
+            self._commit_ready()
+
+    async def _stop_workers(self):
+        # no page may reach the committer once the sink is closing
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    async def run(self):
+        self.task = self.session.query(TaskDB).get(self.task_id)
+        if not self.task:
+            logger.error(f"Task {self.task_id} not found")
+            self.session.close()
+            return
+        # from here on the row is only tracked in memory
+        self.session.expunge(self.task)
+        self.rows = rows = self._resume()
+        self.output_bytes = output_size(self.task.data_file_path)
+        self.expected_rows = self.task.expected_rows
+        self.watermark = Watermark.of_task(self.task)
+        if self.task.base_task_id:
+            base = self.session.get(TaskDB, self.task.base_task_id)
+            self.since = Watermark.of_task(base) if base else None
+        self.session.rollback()
+        output_format = self.task.output_format or "csv"
+        self.seen = await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: SeenIds.from_ids(
+                read_output_ids(self.task.data_file_path, output_format)
+            ),
+        )
+        self.next_page = self.task.current_page
+        self.total_known = self.task.current_page > 0
+        self.sink = open_sink(
+            self.task.data_file_path,
+            output_format,
+            self.task.current_page,
+            rows,
+            self._part_prefix(),
+        )
+
+        PageFetchEngine.running.append(self)
+        try:
+            while not self._finished():
+                # a worker only dies on an error of its own, and the committer
+                # on a write error; the task cannot go on
+                for future in [*self.workers, self.committer]:
+                    if (
+                        future is not None
+                        and future.done()
+                        and not future.cancelled()
+                        and future.exception()
+                    ):
+                        raise future.exception()
+                # one worker per online account, shared with the other tasks
+                alive = [w for w in self.workers if not w.done()]
+                for _ in range(self._worker_target() - len(alive)):
+                    alive.append(asyncio.ensure_future(self._worker()))
+                self.workers = alive
+                if not alive:
+                    if account_pool.online_count() == 0:
+                        logger.error("No available account")
+                        await asyncio.sleep(self.rescan_interval)
+                    else:
+                        # the other tasks hold every account for now
+                        await asyncio.sleep(self.stop_poll_interval)
+                    continue
+                waiting = alive
+                if self.committer is not None and not self.committer.done():
+                    waiting = alive + [self.committer]
+                await asyncio.wait(
+                    waiting,
+                    timeout=self.rescan_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+            # Mark task as done if completed, once its output is durable
+            await self._stop_workers()
+            if self.committer is not None:
+                await self.committer
+            await self._close_sink()
+            if self.task.current_page >= self.task.total_page:
+                self.task.done = True
+                db_writer.update_task(self.task_id, done=True)
+        except RetryExhausted as e:
+            # keep what is on disk, the task can be resumed once upstream recovers
+            logger.error(f"Task {self.task_id} stopped: {str(e)}")
+            self.task.stop_flag = True
+            self.task.error = str(e)
+            db_writer.update_task(self.task_id, stop_flag=True, error=str(e))
+        finally:
+            PageFetchEngine.running.remove(self)
+            await self._stop_workers()
+            # the page being written is finished, never cut off in the middle;
+            # without the lease it is dropped, the output is another run's now
+            if self.committer is not None:
+                if self.lease_lost:
+                    self.committer.cancel()
+                await asyncio.gather(self.committer, return_exceptions=True)
+            for fetched in self.completed.values():
+                fetched.spool.close()
+            if self.lease_lost:
+                logger.warning(f"Task {self.task_id} abandoned, another worker has it")
+                await self._abandon_output()
+            elif self.sink is not None:
+                await self._close_sink()
+            self.output.shutdown(wait=False)
+            if not self.lease_lost:
+                self.task.stop_flag = self.task.stop_flag or self.stop_flag
+                self._publish()
+                await db_writer.flush()
+                await record_store.flush()
+            self.session.close()
@@ -0,0 +1,83 @@
+import os
+import aiohttp
+from typing import List, Optional
+from metrics import request_trace_config
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# the upstream API, point it at a local stand-in (bench/mock_antgst.py) to test offline
+ANTGST_BASE_URL = os.environ.get(
+    "ANTGST_BASE_URL", "https://web.antgst.com/antgst"
+).rstrip("/")
+
+
+def antgst_url(path: str) -> str:
+    """Full URL of an upstream endpoint, path starts with a slash"""
+    return ANTGST_BASE_URL + path
+
+
+class HttpClient:
+    """
+    Application-scoped aiohttp session shared by account, auth and spider code.
+
+    One connection pool with keep-alive and a DNS cache, so requests to
+    web.antgst.com reuse warm TCP+TLS connections instead of paying a fresh
+    handshake each time.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 30,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: float = 60,
+        total_timeout: float = 120,
+        connect_timeout: float = 15,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, connect=connect_timeout
+        )
+        # request hooks, the /metrics latency histogram and e.g. the benchmark
+        self.trace_configs: List[aiohttp.TraceConfig] = [request_trace_config()]
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        """Open the shared session, called from the FastAPI startup event"""
+        self.get_session()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            # every account authenticates with its own X-Access-Token header,
+            # a shared cookie jar would only leak state between accounts
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                trace_configs=self.trace_configs,
+            )
+            logger.info(
+                f"HTTP client session opened, limit={self.limit}, limit_per_host={self.limit_per_host}"
+            )
+        return self._session
+
+    async def close(self):
+        """Close the shared session, called from the FastAPI shutdown event"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("HTTP client session closed")
+        self._session = None
+
+
+http_client = HttpClient()
@@ -0,0 +1,382 @@
+import asyncio
+import codecs
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from utils.logger_config import get_logger
+from watermark import Watermark
+
+logger = get_logger(__name__)
+
+RECORDS_START = re.compile(r'"records"\s*:\s*\[')
+BATCH_SIZE = 500
+# a page spool stays in memory up to this size, bigger pages go to a temp file
+SPOOL_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# a response body stays in memory up to this size, bigger ones go to a temp
+# file and are parsed incrementally; smaller ones are decoded whole (orjson)
+BODY_MAX_SIZE = 1024 * 1024
+
+
+class IngestConfig:
+    """Where response bodies are decoded, off the event loop"""
+
+    # process: a pool of spawned processes, decoding runs in parallel with the
+    #          loop and the other pages; thread: a thread pool, lighter but
+    #          holding the GIL while it decodes
+    executor = os.environ.get("INGEST_EXECUTOR", "process")
+    workers = int(os.environ.get("INGEST_WORKERS", 0)) or min(4, os.cpu_count() or 1)
+
+
+ingest_config = IngestConfig()
+
+
+class RecordStreamParser:
+    """
+    Incremental parser for a sendRecordList response body.
+
+    Text is fed in chunks as it arrives; every complete object of the
+    result.records array is returned as soon as its closing brace is seen, so
+    the full page is never held in memory. Everything around the array is kept
+    (it is small) and decoded at the end to get result.pages and friends.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.prefix = ""
+        self.suffix = ""
+        self.state = "prefix"
+
+    def feed(self, text: str) -> List[dict]:
+        records = []
+        self.buffer += text
+        if self.state == "prefix":
+            match = RECORDS_START.search(self.buffer)
+            if not match:
+                return records
+            self.prefix = self.buffer[: match.end() - 1]
+            self.buffer = self.buffer[match.end() :]
+            self.state = "records"
+        if self.state == "records":
+            records = self._parse_records()
+        if self.state == "suffix":
+            self.suffix += self.buffer
+            self.buffer = ""
+        return records
+
+    def _parse_records(self) -> List[dict]:
+        records = []
+        pos = 0
+        size = len(self.buffer)
+        while True:
+            while pos < size and self.buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= size:
+                break
+            if self.buffer[pos] == "]":
+                self.state = "suffix"
+                pos += 1
+                break
+            try:
+                record, pos = self.decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                # the object is cut by the chunk boundary, wait for more text
+                break
+            records.append(record)
+        self.buffer = self.buffer[pos:]
+        return records
+
+    def result(self) -> dict:
+        """The response with an empty records array, valid once fed completely"""
+        if self.state == "prefix":
+            return json.loads(self.buffer)
+        if self.state != "suffix":
+            raise ValueError("Response body ended inside the records array")
+        return json.loads(self.prefix + "[]" + self.suffix)
+
+
+def iter_body_batches(
+    chunks: Iterable[bytes], charset: str, batch_size: int = BATCH_SIZE
+) -> Tuple[Iterator[List[dict]], RecordStreamParser]:
+    """result.records of a response body in batches, and the parser for the rest"""
+    parser = RecordStreamParser()
+
+    def batches() -> Iterator[List[dict]]:
+        text_decoder = codecs.getincrementaldecoder(charset)()
+        batch: List[dict] = []
+        for chunk in chunks:
+            batch.extend(parser.feed(text_decoder.decode(chunk)))
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        batch.extend(parser.feed(text_decoder.decode(b"", final=True)))
+        if batch:
+            yield batch
+
+    return batches(), parser
+
+
+def _memory_chunks(body: bytes) -> Iterator[bytes]:
+    for start in range(0, len(body), CHUNK_SIZE):
+        yield body[start : start + CHUNK_SIZE]
+
+
+def _file_chunks(path: str) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        # gone from the directory at once, the open file keeps the data
+        os.unlink(path)
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _remove(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class ResponseBody:
+    """
+    A response body as it comes off the socket, for the ingest pool.
+
+    Chunks are kept in memory up to max_size; past that they are written to
+    a temp file, so the loop never holds a big page. handover() gives the
+    bytes or the path of the file, which decode_page removes.
+    """
+
+    def __init__(self, max_size: int = BODY_MAX_SIZE):
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.file = None
+        self.path: Optional[str] = None
+
+    def write(self, chunk: bytes):
+        if self.file is not None:
+            self.file.write(chunk)
+            return
+        self.buffer += chunk
+        if len(self.buffer) > self.max_size:
+            fd, self.path = tempfile.mkstemp(prefix="body-", suffix=".json")
+            self.file = os.fdopen(fd, "wb")
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def handover(self) -> Union[bytes, str]:
+        if self.file is None:
+            return bytes(self.buffer)
+        self.file.close()
+        return self.path
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            _remove(self.path)
+
+
+class PageSpool:
+    """
+    Staging area for one fetched page until it is its turn to be written.
+
+    Record batches are pickled into memory for small pages and roll over to
+    a temp file for big ones. A spool filled in another process is handed
+    over with pack() and unpack(), by path once it is on disk, so a big page
+    is never copied between the processes.
+    """
+
+    def __init__(self, max_size: int = SPOOL_MAX_SIZE, file=None, rows: int = 0):
+        self.max_size = max_size
+        self.file = file if file is not None else io.BytesIO()
+        self.path: Optional[str] = None  # the temp file, once rolled over
+        self.rows = rows
+
+    def write(self, batch: List[dict]):
+        pickle.dump(batch, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.rows += len(batch)
+        if isinstance(self.file, io.BytesIO) and self.file.tell() > self.max_size:
+            fd, self.path = tempfile.mkstemp(prefix="page-", suffix=".spool")
+            file = os.fdopen(fd, "w+b")
+            file.write(self.file.getbuffer())
+            self.file = file
+
+    def batches(self) -> Iterator[List[dict]]:
+        self.file.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.file)
+            except EOFError:
+                return
+
+    def pack(self) -> Union[bytes, str]:
+        """The pickled batches, as bytes or in a temp file (its path) when big"""
+        if self.path is None:
+            data = self.file.getvalue()
+            self.close()
+            return data
+        path, self.path = self.path, None
+        self.file.close()
+        return path
+
+    @classmethod
+    def unpack(cls, data: Union[bytes, str], rows: int) -> "PageSpool":
+        if isinstance(data, str):
+            file = open(data, "rb")
+            # gone from the directory at once, the open file keeps the data
+            os.unlink(data)
+        else:
+            file = io.BytesIO(data)
+        return cls(file=file, rows=rows)
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            _remove(self.path)
+            self.path = None
+
+
+def _loads(body: Union[bytes, str], charset: str):
+    """A small body whole with orjson when it is installed, else None"""
+    if not isinstance(body, bytes) or len(body) > BODY_MAX_SIZE:
+        return None
+    if charset.replace("-", "").lower() != "utf8":
+        return None
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson.loads(body)
+
+
+def decode_page(
+    body: Union[bytes, str], charset: str, since: Optional[Watermark]
+) -> Tuple[dict, Union[bytes, str], int, Watermark, bool]:
+    """
+    Decode a sendRecordList body and pickle its records for the output.
+
+    Runs in the ingest executor, on the body bytes or the path of the file
+    holding them (which it removes). Records at or below since (an
+    incremental crawl) are dropped. Returns the response with an empty
+    records array, the packed spool, its row count, the watermark of the
+    records and whether any were dropped.
+    """
+    envelope = _loads(body, charset)
+    if envelope is not None:
+        result = envelope.get("result") if isinstance(envelope, dict) else None
+        records = result.get("records") if isinstance(result, dict) else None
+        if isinstance(records, list):
+            result["records"] = []
+        else:
+            records = []
+        batches = (
+            records[start : start + BATCH_SIZE]
+            for start in range(0, len(records), BATCH_SIZE)
+        )
+        parser = None
+    else:
+        chunks = _memory_chunks(body) if isinstance(body, bytes) else _file_chunks(body)
+        batches, parser = iter_body_batches(chunks, charset)
+
+    spool = PageSpool()
+    newest = Watermark()
+    reached = False
+    try:
+        for batch in batches:
+            if since is not None:
+                new = [r for r in batch if not since.seen(r)]
+                reached = reached or len(new) < len(batch)
+                batch = new
+            newest.observe(batch)
+            spool.write(batch)
+        if parser is not None:
+            envelope = parser.result()
+    except BaseException:
+        spool.close()
+        raise
+    return envelope, spool.pack(), spool.rows, newest, reached
+
+
+def _discard(body: Union[bytes, str], future: asyncio.Future):
+    if isinstance(body, str):
+        # not decoded at all when the pool was shut down first
+        _remove(body)
+    if not future.cancelled() and future.exception() is None:
+        data = future.result()[1]
+        if isinstance(data, str):
+            _remove(data)
+
+
+class PageDecoder:
+    """
+    Runs decode_page on a bounded pool, so the loop only reads bodies.
+
+    Decoding a page of thousands of records and pickling them takes long
+    enough to stall every other coroutine of the process; on the pool it
+    overlaps with the network and with the pages of other tasks.
+    """
+
+    def __init__(self, config: IngestConfig = ingest_config):
+        self.config = config
+        self.pool: Optional[Executor] = None
+
+    def _executor(self) -> Executor:
+        if self.pool is None:
+            if self.config.executor == "process":
+                # spawn: a fork would copy the loop, sockets and locks
+                self.pool = ProcessPoolExecutor(
+                    self.config.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self.pool = ThreadPoolExecutor(
+                    self.config.workers, thread_name_prefix="ingest"
+                )
+            logger.info(
+                f"Decoding pages on {self.config.workers} {self.config.executor} workers"
+            )
+        return self.pool
+
+    async def decode(
+        self,
+        body: Union[bytes, str],
+        charset: Optional[str],
+        since: Optional[Watermark],
+    ) -> Tuple[dict, PageSpool, Watermark, bool]:
+        """(response without records, spool of the records, their watermark, reached)"""
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor(), decode_page, body, charset or "utf-8", since
+        )
+        try:
+            envelope, data, rows, newest, reached = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the page is decoded anyway, its files must not be left behind
+            future.add_done_callback(partial(_discard, body))
+            raise
+        except BrokenProcessPool:
+            # a worker process died, the page is retried on a fresh pool
+            logger.error("Ingest pool broken, starting a new one")
+            self.pool = None
+            if isinstance(body, str):
+                _remove(body)
+            raise
+        return envelope, PageSpool.unpack(data, rows), newest, reached
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+page_decoder = PageDecoder()
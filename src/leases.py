@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import case, or_
+from sqlalchemy.exc import IntegrityError
+
+from database import LeaseDB, SessionLocal, TaskDB
+from db_writer import db_writer
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class WorkerConfig:
+    """How spider work is split between processes, set with SPIDER_MODE"""
+
+    # all: one process serves the web app and runs spiders, scheduler and
+    #      health checks, as before
+    # web: serve the web app only; starting a task marks it for the workers
+    # worker: (python worker.py) claim and run tasks; one elected worker
+    #      also runs the scheduler, the crawl planner and the health checks
+    mode = os.environ.get("SPIDER_MODE", "all")
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    max_tasks = int(os.environ.get("WORKER_MAX_TASKS", 4))  # tasks per worker
+    poll_interval = 5  # seconds between claiming rounds and lease renewals
+    lease_ttl = 60  # seconds a lease outlives the last renewal
+    reclaim_delay = 60  # a task that ended unfinished waits this long to be claimed
+
+    @property
+    def local_spiders(self) -> bool:
+        """Spiders run in the process that starts them, without leases"""
+        return self.mode == "all"
+
+
+worker_config = WorkerConfig()
+
+LEADER = "leader"
+WORKER_PREFIX = "worker:"  # one lease per live worker, named after it
+
+# a task started again is claimable at once, unless a worker still runs it
+RECLAIM_NOW = case((TaskDB.lease_owner == None, None), else_=TaskDB.lease_expires)
+
+
+def _claimable(now: datetime, owner: str):
+    # started, not finished, and not held by a live worker
+    return (
+        TaskDB.done == False,
+        TaskDB.stop_flag == False,
+        TaskDB.queued == False,
+        or_(
+            TaskDB.lease_expires == None,
+            TaskDB.lease_expires < now,
+            TaskDB.lease_owner == owner,
+        ),
+    )
+
+
+def claimable_task_ids(owner: str, limit: int) -> List[int]:
+    """Tasks waiting for a worker, oldest first"""
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(TaskDB.id)
+            .filter(*_claimable(datetime.now(), owner))
+            .order_by(TaskDB.id)
+            .limit(limit)
+            .all()
+        )
+        return [row.id for row in rows]
+    finally:
+        session.close()
+
+
+def active_task_ids() -> List[int]:
+    """Tasks started and not finished, running on a worker or about to be"""
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(TaskDB.id)
+            .filter(
+                TaskDB.done == False, TaskDB.stop_flag == False, TaskDB.queued == False
+            )
+            .all()
+        )
+        return [row.id for row in rows]
+    finally:
+        session.close()
+
+
+async def claim_task(task_id: int, owner: str) -> bool:
+    """Take the lease of a task, False when another worker got it first"""
+
+    def claim(session):
+        now = datetime.now()
+        return (
+            session.query(TaskDB)
+            .filter(TaskDB.id == task_id, *_claimable(now, owner))
+            .update(
+                {
+                    "lease_owner": owner,
+                    "lease_expires": now + timedelta(seconds=worker_config.lease_ttl),
+                },
+                synchronize_session=False,
+            )
+        )
+
+    return bool(await db_writer.run(claim))
+
+
+async def renew_task_leases(owner: str, task_ids: List[int]) -> List[int]:
+    """Extend the leases of the tasks a worker runs, returns the ones it still holds"""
+    if not task_ids:
+        return []
+
+    def renew(session):
+        query = session.query(TaskDB).filter(
+            TaskDB.id.in_(task_ids), TaskDB.lease_owner == owner
+        )
+        query.update(
+            {
+                "lease_expires": datetime.now()
+                + timedelta(seconds=worker_config.lease_ttl)
+            },
+            synchronize_session=False,
+        )
+        return [task.id for task in query.with_entities(TaskDB.id)]
+
+    return await db_writer.run(renew)
+
+
+async def release_task(task_id: int, owner: str, delay: float = 0):
+    """Give up a task; if it is still unfinished no worker claims it for delay seconds"""
+
+    def release(session):
+        session.query(TaskDB).filter(
+            TaskDB.id == task_id, TaskDB.lease_owner == owner
+        ).update(
+            {
+                "lease_owner": None,
+                "lease_expires": datetime.now() + timedelta(seconds=delay),
+            },
+            synchronize_session=False,
+        )
+
+    await db_writer.run(release)
+
+
+async def acquire_lease(
+    name: str, owner: str, ttl: float, state: Optional[str] = None
+) -> bool:
+    """Take or renew a named lease, True while this owner holds it"""
+
+    def acquire(session):
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=ttl)
+        updated = (
+            session.query(LeaseDB)
+            .filter(
+                LeaseDB.name == name,
+                or_(LeaseDB.owner == owner, LeaseDB.expires_at < now),
+            )
+            .update({"owner": owner, "expires_at": expires_at, "state": state})
+        )
+        if updated:
+            return True
+        if session.get(LeaseDB, name) is not None:
+            return False
+        session.add(LeaseDB(name=name, owner=owner, expires_at=expires_at, state=state))
+        session.flush()
+        return True
+
+    try:
+        return await db_writer.run(acquire)
+    except IntegrityError:
+        # another process created the lease at the same moment
+        return False
+
+
+async def release_lease(name: str, owner: str):
+    """Let the lease expire now, another process can take it right away"""
+    await db_writer.run(
+        lambda session: session.query(LeaseDB)
+        .filter(LeaseDB.name == name, LeaseDB.owner == owner)
+        .update({"expires_at": datetime.now()})
+    )
+
+
+def worker_lease(worker_id: str) -> str:
+    return f"{WORKER_PREFIX}{worker_id}"
+
+
+def live_workers() -> Dict[str, dict]:
+    """The workers whose lease is current, with the state each one reports"""
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(LeaseDB)
+            .filter(
+                LeaseDB.name.like(f"{WORKER_PREFIX}%"),
+                LeaseDB.expires_at >= datetime.now(),
+            )
+            .all()
+        )
+        return {row.owner: json.loads(row.state) if row.state else {} for row in rows}
+    finally:
+        session.close()
+
+
+def account_owner(username: str, workers: Iterable[str]) -> Optional[str]:
+    """
+    The worker that spiders with an account, so each account is paced once.
+
+    Rendezvous hashing: a worker that comes or goes only moves its own share
+    of the accounts.
+    """
+    return max(
+        workers,
+        key=lambda worker: hashlib.sha1(f"{worker}/{username}".encode()).digest(),
+        default=None,
+    )
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class TokenRefreshConfig:
+    """When tokens are renewed ahead of their expiry"""
+
+    # seconds a token lives; learned from the tokens seen expiring unless set
+    lifetime = float(os.environ.get("TOKEN_LIFETIME", 0)) or None
+    margin = 0.2  # share of the lifetime left when a token is renewed
+    interval = 60  # seconds between scans for tokens due
+    concurrency = 5  # renewals at the same time
+    observations = 20  # expiries the learned lifetime is taken from
+
+
+token_refresh_config = TokenRefreshConfig()
+
+
+class LoginCoordinator:
+    """
+    One login in flight per account, and the age of every token.
+
+    A login started while another one for the same account is running waits
+    for that one instead of fetching its own captcha, whose token would
+    replace (and upstream invalidate) the first. Tokens are stamped when they
+    are issued; an expiry seen by a health check or the spider records how
+    long the token lived, and the lower quartile of those lifetimes tells
+    when the others are due for renewal. A token the spider sees refused is
+    renewed right away through renewer, set by the AccountManager.
+    """
+
+    def __init__(self, config: TokenRefreshConfig = token_refresh_config):
+        self.config = config
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.issued: Dict[str, float] = {}  # username -> when its token was issued
+        self.lifetimes: Deque[float] = deque(maxlen=config.observations)
+        self.renewer: Optional[Callable[[str], Awaitable[bool]]] = None
+        self.renewals: Set[asyncio.Future] = set()
+
+    async def run(self, username: str, login: Callable[[], Awaitable[bool]]) -> bool:
+        """Run login unless one is in flight for username, then share its result"""
+        future = self.in_flight.get(username)
+        if future is None:
+            future = asyncio.ensure_future(login())
+            self.in_flight[username] = future
+
+            def done(finished: asyncio.Future):
+                if self.in_flight.get(username) is finished:
+                    del self.in_flight[username]
+
+            future.add_done_callback(done)
+        else:
+            logger.info(f"Login of {username} already in flight, waiting for it")
+        # a caller that gives up does not cancel the login the others wait for
+        return await asyncio.shield(future)
+
+    def renew_soon(self, username: str):
+        """Log username in again in the background, unless a login is in flight"""
+        if self.renewer is None or username in self.in_flight:
+            return
+        renewal = asyncio.ensure_future(self.renewer(username))
+        self.renewals.add(renewal)
+        renewal.add_done_callback(self.renewals.discard)
+
+    def token_issued(self, username: str, issued_at: Optional[datetime]):
+        if issued_at is not None:
+            self.issued[username] = issued_at.timestamp()
+
+    def token_expired(self, username: str):
+        """A request was refused with the token of username, learn its lifetime"""
+        issued = self.issued.pop(username, None)
+        if issued is None:
+            return
+        lifetime = time.time() - issued
+        self.lifetimes.append(lifetime)
+        logger.info(f"Token of {username} expired after {lifetime:.0f}s")
+
+    def lifetime(self) -> Optional[float]:
+        """Seconds a token can be trusted to live, None while unknown"""
+        if self.config.lifetime:
+            return self.config.lifetime
+        if not self.lifetimes:
+            return None
+        return sorted(self.lifetimes)[len(self.lifetimes) // 4]
+
+    def due(self, username: str, now: Optional[float] = None) -> bool:
+        """True when the token of username should be renewed before it expires"""
+        lifetime = self.lifetime()
+        issued = self.issued.get(username)
+        if lifetime is None or issued is None:
+            return False
+        # renew a scan early at least, a token must not expire between scans
+        ahead = max(lifetime * self.config.margin, 2 * self.config.interval)
+        age = (now or time.time()) - issued
+        return age >= max(lifetime - ahead, lifetime / 2)
+
+
+login_coordinator = LoginCoordinator()
@@ -1,19 +1,43 @@
+import asyncio
 import os
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Query, Request
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import (
+    RedirectResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-from auth import Auth
+from auth import Auth, parse_usernames
 from account import AccountDB, AccountManager
-from database import TaskDB
+from database import DEFAULT_COUNTRY_CODE
 from task_manager import TaskManager
+from crawl_planner import CrawlPlanner, planner_config
 from scheduler import start_scheduler
+from http_client import http_client
+from ingest import page_decoder
+from db_writer import db_writer
+from metrics import monitor_event_loop_lag, registry
+from record_store import FILTER_COLUMNS, INTERVALS, record_store, record_store_config
+from task_events import task_progress
+from leases import worker_config
+from shared_settings import read_settings
+from output_formats import OUTPUT_FORMATS, available_formats, iter_zip_directory
+from exports import (
+    accepts_gzip,
+    file_response,
+    gzip_response,
+    iter_merged_csv,
+    load_tasks,
+)
 
 app = FastAPI()
 auth = Auth()  # Create an instance of Auth
-account_manager = AccountManager()  # Add account manager instance
+# in web mode the health checks run on the leader worker
+account_manager = AccountManager(start_health_check=worker_config.local_spiders)
 task_manager = TaskManager()
+crawl_planner = CrawlPlanner(task_manager)
 
 # Configure templates
 templates = Jinja2Templates(directory=str(Path(__file__).parent / "templates"))
@@ -30,27 +54,28 @@ async def get_task(request: Request):
     page = int(request.query_params.get("page", 1))
     items_per_page = 10
     
-    # Get all tasks and calculate pagination
-    all_tasks = task_manager.get_tasks()
-    total_tasks = len(all_tasks)
+    # Count in SQL and load only the tasks of this page
+    total_tasks = task_manager.count_tasks()
     total_pages = (total_tasks + items_per_page - 1) // items_per_page
     
     # Ensure page is within valid range
     page = max(1, min(page, total_pages)) if total_pages > 0 else 1
     
-    # Get tasks for current page
-    start_idx = (page - 1) * items_per_page
-    end_idx = start_idx + items_per_page
-    page_tasks = all_tasks[start_idx:end_idx]
+    page_tasks = task_manager.get_tasks(items_per_page, (page - 1) * items_per_page)
     
     spider_sleep_time = task_manager.get_spider_sleep_time()
+    spider_config = task_manager.get_spider_config()
     return templates.TemplateResponse(
         "task.html",
         {
             "request": request,
-            "tasks": all_tasks,  # Keep this for backward compatibility
             "page_tasks": page_tasks,
             "spider_sleep_time": spider_sleep_time,
+            "adaptive_pacing": spider_config.adaptive,
+            "pacing": task_manager.get_pacing(),
+            "output_formats": available_formats(),
+            "plans": crawl_planner.get_plans(),
+            "max_running_tasks": planner_config.max_running_tasks,
             "page": page,
             "total_pages": total_pages,
             "range": range,  # Add range function to template context
@@ -58,15 +83,30 @@ async def get_task(request: Request):
     )
 
 
+@app.get("/task/events")
+async def task_events():
+    """Server-sent events with the progress of the running tasks"""
+    return StreamingResponse(
+        task_progress.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/create_task")
 async def create_task(request: Request):
     form_data = await request.form()
     date = form_data.get("date")
+    output_format = str(form_data.get("output_format", "csv"))
+    incremental = form_data.get("incremental") == "on"
 
     if not date:
         return {"error": "Date is required"}
 
-    await task_manager.create_task(date)  # type: ignore
+    try:
+        await task_manager.create_task(date, output_format, incremental)  # type: ignore
+    except ValueError as e:
+        return {"error": str(e)}
     return RedirectResponse(url="/task", status_code=303)
 
 
@@ -82,16 +122,139 @@ async def stop_task(task_id: int):
     return RedirectResponse(url="/task", status_code=303)
 
 
+@app.post("/create_plan")
+async def create_plan(request: Request):
+    form_data = await request.form()
+    try:
+        await crawl_planner.create_plan(
+            str(form_data.get("start_date", "")),
+            str(form_data.get("end_date", "")),
+            str(form_data.get("country_codes", "")),
+            str(form_data.get("output_format", "csv")),
+        )
+    except ValueError as e:
+        return {"error": str(e)}
+    return RedirectResponse(url="/task", status_code=303)
+
+
+@app.post("/start_plan/{plan_id}")
+async def start_plan(plan_id: int):
+    await crawl_planner.start_plan(plan_id)
+    return RedirectResponse(url="/task", status_code=303)
+
+
+@app.post("/stop_plan/{plan_id}")
+async def stop_plan(plan_id: int):
+    await crawl_planner.stop_plan(plan_id)
+    return RedirectResponse(url="/task", status_code=303)
+
+
+@app.post("/update_max_running_tasks")
+async def update_max_running_tasks(request: Request):
+    form_data = await request.form()
+    max_running_tasks = int(str(form_data.get("max_running_tasks", 4)))
+    await crawl_planner.set_max_running_tasks(max_running_tasks)
+    return RedirectResponse(url="/task", status_code=303)
+
+
 @app.get("/download/{task_id}")
-async def download_file(task_id: int):
-    task = task_manager.session.query(TaskDB).get(task_id)
+async def download_file(task_id: int, request: Request):
+    tasks = await load_tasks([task_id])
+    task = tasks[0] if tasks else None
     if task and task.data_file_path and os.path.exists(task.data_file_path):
-        return FileResponse(
-            task.data_file_path, filename=os.path.basename(task.data_file_path)
-        )
+        _, media_type = OUTPUT_FORMATS[task.output_format or "csv"]
+        filename = os.path.basename(task.data_file_path)
+        if os.path.isdir(task.data_file_path):
+            # columnar output is a directory of part files, send it as one zip
+            return StreamingResponse(
+                iter_zip_directory(task.data_file_path),
+                media_type=media_type,
+                headers={
+                    "Content-Disposition": f'attachment; filename="{filename}.zip"'
+                },
+            )
+        return file_response(request, task.data_file_path, filename, media_type)
     return {"error": "File not found"}
 
 
+@app.get("/export")
+async def export(request: Request):
+    """One CSV of several finished tasks: ?tasks=1,2,3 or ?start_date=&end_date="""
+    params = request.query_params
+    try:
+        if params.get("tasks"):
+            task_ids = [int(task_id) for task_id in params["tasks"].split(",")]
+            tasks = await load_tasks(task_ids)
+        else:
+            tasks = await load_tasks(
+                start_date=params["start_date"],
+                end_date=params["end_date"],
+                country_code=params.get("country_code") or DEFAULT_COUNTRY_CODE,
+            )
+    except (KeyError, ValueError):
+        return {"error": "Give tasks or a start_date and end_date"}
+    tasks = [
+        task
+        for task in tasks
+        if task.done and task.data_file_path and os.path.exists(task.data_file_path)
+    ]
+    if not tasks:
+        return {"error": "No finished task to export"}
+    dates = sorted(task.date for task in tasks)
+    filename = f"export_{dates[0]}_{dates[-1]}.csv"
+    chunks = iter_merged_csv(tasks)
+    if accepts_gzip(request):
+        return gzip_response(chunks, filename, "text/csv")
+    return StreamingResponse(
+        chunks,
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _record_filters(request: Request) -> dict:
+    params = request.query_params
+    return {name: params[name] for name in FILTER_COLUMNS if params.get(name)}
+
+
+@app.get("/api/records")
+async def query_records(
+    request: Request, limit: int = Query(100, ge=1, le=record_store_config.max_limit)
+):
+    """Stored records, filtered by column and sendTime, paged with ?after=<next>"""
+    if not record_store.enabled:
+        return {"error": "Record store is disabled, start the app with RECORD_STORE=1"}
+    params = request.query_params
+    return await record_store.query(
+        _record_filters(request),
+        params.get("start_time", ""),
+        params.get("end_time", ""),
+        limit,
+        params.get("after"),
+    )
+
+
+@app.get("/api/records/stats")
+async def record_stats(request: Request):
+    """Counts per ?group_by=operator,sendResult and/or ?interval=hour|day"""
+    if not record_store.enabled:
+        return {"error": "Record store is disabled, start the app with RECORD_STORE=1"}
+    params = request.query_params
+    group_by = [name for name in params.get("group_by", "").split(",") if name]
+    interval = params.get("interval") or None
+    if any(name not in FILTER_COLUMNS for name in group_by):
+        return {"error": f"group_by takes {', '.join(sorted(FILTER_COLUMNS))}"}
+    if interval is not None and interval not in INTERVALS:
+        return {"error": f"interval takes {', '.join(INTERVALS)}"}
+    return await record_store.stats(
+        _record_filters(request),
+        params.get("start_time", ""),
+        params.get("end_time", ""),
+        group_by,
+        interval,
+    )
+
+
 @app.get("/change_authority")
 def get_change_authority(request: Request):
     return templates.TemplateResponse("change_authority.html", {"request": request})
@@ -130,10 +293,43 @@ async def post_change_authority(request: Request):
     )
 
 
+@app.post("/change_authority/bulk")
+async def post_change_authority_bulk(request: Request):
+    form_data = await request.form()
+    action = form_data.get("action")
+    text = str(form_data.get("usernames", ""))
+    upload = form_data.get("file")
+    if upload is not None and not isinstance(upload, str):
+        text += "\n" + (await upload.read()).decode("utf-8-sig", errors="replace")
+    usernames = parse_usernames(text)
+
+    if not usernames or action not in ("upgrade", "downgrade"):
+        return templates.TemplateResponse(
+            "change_authority.html",
+            {"request": request, "result": "No usernames given"},
+        )
+
+    report = await auth.change_authority_bulk(usernames, action)
+    succeeded = sum(1 for row in report if row["success"])
+    return templates.TemplateResponse(
+        "change_authority.html",
+        {
+            "request": request,
+            "result": f"Bulk {action}: {succeeded} of {len(report)} users succeeded",
+            "report": report,
+        },
+    )
+
+
 @app.get("/account")
 def get_accounts(request: Request):
     return templates.TemplateResponse(
-        "account.html", {"request": request, "accounts": account_manager.get_accounts()}
+        "account.html",
+        {
+            "request": request,
+            "accounts": account_manager.get_accounts(),
+            "last_sweep": account_manager.last_sweep,
+        },
     )
 
 
@@ -227,16 +423,44 @@ async def login_account(request: Request):
 async def update_sleep_time(request: Request):
     form_data = await request.form()
     sleep_time = int(str(form_data.get("sleep_time", 10)))
-    await task_manager.update_sleep_time(sleep_time)
+    adaptive = form_data.get("adaptive") == "on"
+    await task_manager.update_sleep_time(sleep_time, adaptive)
     return RedirectResponse(url="/task", status_code=303)
 
 
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition of the spider, account and upstream metrics"""
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.on_event("startup")
 async def startup_event():
     """Start the scheduler when the application starts"""
+    await http_client.start()
+    app.state.loop_lag_monitor = asyncio.ensure_future(monitor_event_loop_lag())
+    app.state.crawl_planner = None
+    # the settings last changed in the web app, by this process or an earlier one
+    settings = read_settings()
+    task_manager.apply_settings(settings)
+    crawl_planner.apply_settings(settings)
+    if not worker_config.local_spiders:
+        # SPIDER_MODE=web: tasks, schedules and plans run on the workers
+        return
     start_scheduler()
+    await task_manager.resume_unfinished_tasks()
+    app.state.crawl_planner = asyncio.ensure_future(crawl_planner.run())
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    app.state.loop_lag_monitor.cancel()
+    if app.state.crawl_planner is not None:
+        app.state.crawl_planner.cancel()
     await account_manager.cleanup()
+    await http_client.close()
+    await db_writer.close()
+    await record_store.close()
+    page_decoder.close()
@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """One metric family, with a child value per combination of label values"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+upstream_request_seconds = registry.register(
+    Histogram(
+        "antgst_request_seconds",
+        "Latency of upstream requests until the response headers, by endpoint",
+        ("endpoint", "method", "status"),
+    )
+)
+upstream_request_errors = registry.register(
+    Counter(
+        "antgst_request_errors_total",
+        "Upstream requests that failed without a response, by endpoint",
+        ("endpoint", "method"),
+    )
+)
+# not by task: every task would leave its series behind for good
+spider_pages = registry.register(
+    Counter("spider_pages_total", "Pages written to the outputs of all tasks")
+)
+spider_rows = registry.register(
+    Counter("spider_rows_total", "Records written to the outputs of all tasks")
+)
+spider_output_bytes = registry.register(
+    Counter(
+        "spider_output_bytes_total",
+        "Bytes the outputs of all tasks grew by, counted at checkpoints",
+    )
+)
+accounts_online = registry.register(
+    Gauge("accounts_online", "Accounts logged in and in the spider's account pool")
+)
+health_sweep_seconds = registry.register(
+    Histogram(
+        "account_health_sweep_seconds",
+        "Duration of a full account health check sweep",
+        buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200),
+    )
+)
+account_logins = registry.register(
+    Counter("account_logins_total", "Account logins by result", ("result",))
+)
+auth_cache_lookups = registry.register(
+    Counter(
+        "auth_cache_lookups_total",
+        "Auth user id and role lookups by cache and result (hit, miss)",
+        ("cache", "result"),
+    )
+)
+event_loop_lag_seconds = registry.register(
+    Histogram(
+        "event_loop_lag_seconds",
+        "How late the event loop woke up a sleeping probe",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+    )
+)
+
+
+def endpoint_name(url) -> str:
+    """Last path segment of an upstream URL, a label with bounded values"""
+    path = urlsplit(str(url)).path.rstrip("/")
+    return path.rsplit("/", 1)[-1] or "/"
+
+
+def request_trace_config() -> aiohttp.TraceConfig:
+    """Times every request of an aiohttp session into antgst_request_seconds"""
+
+    async def on_start(session, context, params):
+        context.started = time.monotonic()
+
+    async def on_end(session, context, params):
+        upstream_request_seconds.observe(
+            time.monotonic() - context.started,
+            endpoint=endpoint_name(params.url),
+            method=params.method,
+            status=params.response.status,
+        )
+
+    async def on_exception(session, context, params):
+        upstream_request_errors.inc(
+            endpoint=endpoint_name(params.url), method=params.method
+        )
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_start)
+    trace_config.on_request_end.append(on_end)
+    trace_config.on_request_exception.append(on_exception)
+    return trace_config
+
+
+async def monitor_event_loop_lag(interval: float = 1.0):
+    """Sleep interval seconds in a loop and record how much later than asked we woke up"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, time.monotonic() - started - interval))
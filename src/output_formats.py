@@ -0,0 +1,562 @@
+import csv
+import gzip
+import io
+import os
+import re
+import shutil
+import zipfile
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional
+
+from database import DEFAULT_COUNTRY_CODE
+from ingest import PageSpool
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# every field the spider asks sendRecordList for, with the type it is stored as
+RECORD_SCHEMA = [
+    ("id", "string"),
+    ("userName", "string"),
+    ("countryName", "string"),
+    ("operator", "string"),
+    ("smsFrom", "string"),
+    ("smsTo", "string"),
+    ("message", "string"),
+    ("sendResult", "string"),
+    ("gatewayDr", "string"),
+    ("gatewayRealDr", "string"),
+    ("intervalTime", "int"),
+    ("smsCount", "int"),
+    ("smsFee", "float"),
+    ("currency", "string"),
+    ("sendDrStatus", "string"),
+    ("resendDrTimes", "int"),
+    ("sendTime", "timestamp"),
+    ("updateTime", "timestamp"),
+    ("gatewayName", "string"),
+    ("gatewayResult", "string"),
+    ("validateResult", "string"),
+    ("action", "string"),
+    ("createTime", "timestamp"),
+]
+RECORD_COLUMNS = [name for name, _ in RECORD_SCHEMA]
+
+# the columns of the plain csv output, kept as they were for existing consumers
+LEGACY_CSV_COLUMNS = [
+    "id",
+    "userName",
+    "countryName",
+    "operator",
+    "smsFrom",
+    "smsTo",
+    "message",
+    "sendResult",
+    "sendTime",
+]
+
+# format name -> (file extension, media type of /download)
+OUTPUT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+    "csv.zst": (".csv.zst", "application/zstd"),
+    "parquet": (".parquet", "application/zip"),
+}
+DEFAULT_OUTPUT_FORMAT = "csv"
+
+
+def available_formats() -> List[str]:
+    """Output formats usable with the packages installed here"""
+    formats = ["csv", "csv.gz"]
+    try:
+        import zstandard  # noqa: F401
+
+        formats.append("csv.zst")
+    except ImportError:
+        pass
+    try:
+        import pyarrow  # noqa: F401
+
+        formats.append("parquet")
+    except ImportError:
+        pass
+    return formats
+
+
+class OutputSink:
+    """
+    Writes record batches of one task, the file stays open for the whole run.
+
+    checkpoint() makes everything written so far durable and returns an
+    offset to resume from, so a run that dies later can be cut back to a page
+    boundary instead of appending the same page twice.
+    """
+
+    def __init__(self, path: str, rows: int = 0):
+        self.path = path
+        self.rows = rows
+
+    def write_batch(self, batch: List[dict]):
+        raise NotImplementedError
+
+    def write_spool(
+        self,
+        spool: PageSpool,
+        keep: Optional[Callable[[List[dict]], List[dict]]] = None,
+    ):
+        """Write a staged page, keep() picks the records of each batch to write"""
+        for batch in spool.batches():
+            if keep is not None:
+                batch = keep(batch)
+            if batch:
+                self.write_batch(batch)
+                self.rows += len(batch)
+
+    def checkpoint(self, next_page: int, final: bool = False) -> Optional[int]:
+        """Make the pages before next_page durable, None when not possible yet"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def abandon(self):
+        """Let go of the output without writing to it again, another run owns it now"""
+        self.close()
+
+
+def _fsync(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _drop_writes(file):
+    """Point the descriptor of file at /dev/null, closing it writes nothing more"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, file.fileno())
+    finally:
+        os.close(devnull)
+
+
+class CsvSink(OutputSink):
+    """Plain CSV with the legacy nine columns and no header"""
+
+    def __init__(self, path: str, rows: int = 0, buffer_size: int = 1024 * 1024):
+        super().__init__(path, rows)
+        self.file: Optional[io.TextIOBase] = open(
+            path, "a", newline="", buffering=buffer_size
+        )
+        self.writer = csv.writer(self.file)
+
+    def write_batch(self, batch: List[dict]):
+        self.writer.writerows(
+            [[record.get(column) for column in LEGACY_CSV_COLUMNS] for record in batch]
+        )
+
+    def checkpoint(self, next_page: int, final: bool = False) -> Optional[int]:
+        _fsync(self.file)
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def abandon(self):
+        # the rows still buffered are dropped, not appended
+        if self.file is not None:
+            _drop_writes(self.file)
+        self.close()
+
+
+class CompressedCsvSink(OutputSink):
+    """
+    CSV of every requested field with a header row, gzip or zstd compressed.
+
+    Every checkpoint ends the current gzip member or zstd frame, so the file
+    can be cut back to any checkpoint and still decompress as one stream.
+    """
+
+    def __init__(self, path: str, compression: str, rows: int = 0):
+        super().__init__(path, rows)
+        self.compression = compression
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        # an output started before a field was added keeps the columns it has
+        self.columns = RECORD_COLUMNS
+        if not new_file:
+            output_format = "csv.gz" if compression == "gzip" else "csv.zst"
+            self.columns = _csv_header(path, output_format) or RECORD_COLUMNS
+        self.raw = open(path, "ab")
+        self.file: Optional[io.TextIOWrapper] = None
+        self._open_frame()
+        if new_file:
+            self.writer.writerow(self.columns)
+
+    def _open_frame(self):
+        if self.compression == "gzip":
+            # appending starts a new gzip member, readers see one stream
+            compressed = gzip.GzipFile(fileobj=self.raw, mode="ab")
+        else:
+            import zstandard
+
+            compressed = zstandard.ZstdCompressor().stream_writer(
+                self.raw, closefd=False
+            )
+        self.file = io.TextIOWrapper(compressed, newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+
+    def write_batch(self, batch: List[dict]):
+        self.writer.writerows(
+            [[record.get(column) for column in self.columns] for record in batch]
+        )
+
+    def checkpoint(self, next_page: int, final: bool = False) -> Optional[int]:
+        # closing the wrapper ends the member or frame but leaves raw open
+        self.file.close()
+        _fsync(self.raw)
+        offset = self.raw.tell()
+        if final:
+            self.file = None
+        else:
+            self._open_frame()
+        return offset
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.raw.close()
+
+    def abandon(self):
+        # the open member or frame is dropped, not ended
+        _drop_writes(self.raw)
+        self.close()
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_timestamp(value) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def _to_string(value) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+CONVERTERS = {
+    "string": _to_string,
+    "int": _to_int,
+    "float": _to_float,
+    "timestamp": _to_timestamp,
+}
+
+
+class ParquetSink(OutputSink):
+    """
+    Typed Parquet output written in row groups.
+
+    The task path is a directory of part files named after their first page.
+    A part is written under a temporary name and renamed once it holds
+    part_rows rows or the run ends; that rename is the checkpoint, so a
+    crashed run only loses the part it was still writing. An incremental task
+    adds its parts to a copy of another task's directory, under part_prefix.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        start_page: int = 0,
+        rows: int = 0,
+        row_group_size: int = 30000,
+        part_rows: int = 300000,
+        part_prefix: str = "",
+    ):
+        super().__init__(path, rows)
+        self.part_prefix = part_prefix
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        types = {
+            "string": pa.string(),
+            "int": pa.int64(),
+            "float": pa.float64(),
+            "timestamp": pa.timestamp("s"),
+        }
+        os.makedirs(path, exist_ok=True)
+        # parts added to an older output keep its schema, the directory reads as one
+        stored = _parquet_columns(path)
+        self.record_schema = [
+            (name, kind)
+            for name, kind in RECORD_SCHEMA
+            if stored is None or name in stored
+        ]
+        self.schema = pa.schema(
+            [(name, types[kind]) for name, kind in self.record_schema]
+        )
+        self.row_group_size = row_group_size
+        self.part_rows_limit = part_rows
+        self.columns = {name: [] for name, _ in self.record_schema}
+        self.buffered = 0
+        self.part_start = start_page
+        self.writer = None
+        self.part_rows = 0
+
+    def _part_path(self) -> str:
+        return os.path.join(
+            self.path, f"part-{self.part_prefix}{self.part_start:06d}.parquet"
+        )
+
+    def write_batch(self, batch: List[dict]):
+        for name, kind in self.record_schema:
+            convert = CONVERTERS[kind]
+            self.columns[name].extend(convert(record.get(name)) for record in batch)
+        self.buffered += len(batch)
+        if self.buffered >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        if not self.buffered:
+            return
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(
+                self._part_path() + ".tmp", self.schema, compression="zstd"
+            )
+        table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.part_rows += self.buffered
+        self.columns = {name: [] for name, _ in self.record_schema}
+        self.buffered = 0
+
+    def _finish_part(self):
+        self._write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            with open(self._part_path() + ".tmp", "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(self._part_path() + ".tmp", self._part_path())
+        self.part_rows = 0
+
+    def checkpoint(self, next_page: int, final: bool = False) -> Optional[int]:
+        if not final and self.part_rows + self.buffered < self.part_rows_limit:
+            return None
+        self._finish_part()
+        self.part_start = next_page
+        # the offset of a directory output is the number of finished parts
+        return len(
+            [name for name in os.listdir(self.path) if name.endswith(".parquet")]
+        )
+
+    def close(self):
+        # an unfinished part is dropped, its pages are fetched again on resume
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.remove(self._part_path() + ".tmp")
+
+    def abandon(self):
+        # the new owner removes the unfinished part, by now it may be its own
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def output_path(
+    output_dir: str,
+    date: str,
+    output_format: str,
+    country_code: str = DEFAULT_COUNTRY_CODE,
+) -> str:
+    extension, _ = OUTPUT_FORMATS[output_format]
+    # the default country keeps the original file name
+    name = date if country_code == DEFAULT_COUNTRY_CODE else f"{date}_{country_code}"
+    stem = os.path.join(
+        output_dir, f"data_{name}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    )
+    # tasks of the same day created within a second must not share a file
+    path, n = stem + extension, 1
+    while os.path.exists(path):
+        path, n = f"{stem}_{n}{extension}", n + 1
+    return path
+
+
+def create_output(path: str, output_format: str):
+    """Create the empty result of a new task"""
+    if output_format == "parquet":
+        os.makedirs(path, exist_ok=True)
+    else:
+        with open(path, "w") as f:
+            f.write("")
+
+
+def copy_output(source: str, path: str, output_format: str) -> int:
+    """Start an output as a copy of another task's, returns its checkpoint offset"""
+    if output_format == "parquet":
+        shutil.copytree(source, path, ignore=shutil.ignore_patterns("*.tmp"))
+        return len([name for name in os.listdir(path) if name.endswith(".parquet")])
+    shutil.copyfile(source, path)
+    return os.path.getsize(path)
+
+
+def rewind_output(
+    path: str, output_format: str, page: int, offset: int, part_prefix: str = ""
+):
+    """Cut an output back to the checkpoint at page, dropping anything written after it"""
+    if output_format == "parquet":
+        own_part = re.compile(rf"part-{re.escape(part_prefix)}(\d+)\.parquet")
+        for name in os.listdir(path):
+            match = own_part.fullmatch(name)
+            if name.endswith(".tmp") or (match and int(match.group(1)) >= page):
+                os.remove(os.path.join(path, name))
+    elif os.path.getsize(path) > offset:
+        logger.info(f"Truncating {path} back to checkpoint at page {page}")
+        os.truncate(path, offset)
+
+
+def output_size(path: str) -> int:
+    """Bytes of an output on disk, the finished part files of a directory output"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(path, name))
+        for name in os.listdir(path)
+        if not name.endswith(".tmp")
+    )
+
+
+def _open_text_output(path: str, output_format: str) -> io.TextIOBase:
+    if output_format == "csv.gz":
+        return io.TextIOWrapper(gzip.open(path), newline="", encoding="utf-8")
+    if output_format == "csv.zst":
+        import zstandard
+
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(reader, newline="", encoding="utf-8")
+    return open(path, newline="", encoding="utf-8")
+
+
+def _csv_header(path: str, output_format: str) -> Optional[List[str]]:
+    """The header row of a compressed CSV output, None when it has none yet"""
+    try:
+        with _open_text_output(path, output_format) as file:
+            return next(csv.reader(file), None) or None
+    except (OSError, EOFError, csv.Error) as e:
+        logger.warning(f"Cannot read the header of {path}: {str(e)}")
+        return None
+
+
+def _parquet_columns(path: str) -> Optional[List[str]]:
+    """The columns of the finished parts of a Parquet output, None without parts"""
+    import pyarrow.parquet as pq
+
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".parquet"):
+            return pq.read_schema(os.path.join(path, name)).names
+    return None
+
+
+def iter_output_rows(
+    path: str, output_format: str, columns: List[str]
+) -> Iterator[list]:
+    """The records of a finished output as rows of columns, None where one is missing"""
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".parquet"):
+                continue
+            part = pq.ParquetFile(os.path.join(path, name))
+            # parts written before a field was added do not have it
+            stored = [c for c in columns if c in part.schema_arrow.names]
+            for batch in part.iter_batches(columns=stored):
+                data = batch.to_pydict()
+                missing = [None] * batch.num_rows
+                yield from map(list, zip(*(data.get(c, missing) for c in columns)))
+        return
+    with _open_text_output(path, output_format) as file:
+        rows = csv.reader(file)
+        stored = LEGACY_CSV_COLUMNS if output_format == "csv" else next(rows, [])
+        index = [stored.index(c) if c in stored else None for c in columns]
+        for row in rows:
+            if row:
+                yield [None if i is None or i >= len(row) else row[i] for i in index]
+
+
+def read_output_ids(path: str, output_format: str) -> Iterator[str]:
+    """The id of every record in an output"""
+    for row in iter_output_rows(path, output_format, ["id"]):
+        yield row[0]
+
+
+def open_sink(
+    path: str,
+    output_format: str,
+    start_page: int = 0,
+    rows: int = 0,
+    part_prefix: str = "",
+) -> OutputSink:
+    if output_format == "csv.gz":
+        return CompressedCsvSink(path, "gzip", rows)
+    if output_format == "csv.zst":
+        return CompressedCsvSink(path, "zstd", rows)
+    if output_format == "parquet":
+        return ParquetSink(path, start_page, rows, part_prefix=part_prefix)
+    return CsvSink(path, rows)
+
+
+class _ZipStream(io.RawIOBase):
+    """Write-only buffer that lets zipfile produce an archive piece by piece"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip_directory(path: str, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Stream a zip of the finished files of a directory output, e.g. Parquet parts"""
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".tmp"):
+                continue
+            with open(os.path.join(path, name), "rb") as src:
+                with archive.open(name, "w", force_zip64=True) as dst:
+                    while True:
+                        data = src.read(chunk_size)
+                        if not data:
+                            break
+                        dst.write(data)
+                        yield stream.drain()
+    yield stream.drain()
@@ -0,0 +1,101 @@
+from collections import deque
+from datetime import datetime
+from typing import Dict, List
+
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class AccountPacer:
+    """AIMD pacing of one account: the delay shrinks by a step while things go well"""
+
+    def __init__(self, username: str, delay: float):
+        self.username = username
+        self.delay = delay
+        self.latency = 0.0  # moving average of the page latency
+        self.baseline = 0.0  # lowest moving average seen, the uncongested latency
+        self.history = deque(maxlen=20)
+        self.history.append((datetime.now(), delay, "start"))
+
+    def set_delay(self, delay: float, reason: str):
+        if abs(delay - self.delay) < 0.01:
+            return
+        self.delay = delay
+        self.history.append((datetime.now(), delay, reason))
+        logger.debug(f"Pacing of {self.username}: {delay:.1f}s ({reason})")
+
+    def observe_latency(self, latency: float) -> bool:
+        """Track the latency, returns True when it rose clearly above the baseline"""
+        self.latency = (
+            latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+        )
+        if not self.baseline or self.latency < self.baseline:
+            self.baseline = self.latency
+        else:
+            # let the baseline follow a lasting change of the network slowly
+            self.baseline += 0.01 * (self.latency - self.baseline)
+        return latency > 2 * self.baseline
+
+
+class RateController:
+    """
+    Adaptive pacing for spider requests, replacing the fixed sleep_time.
+
+    Every account has its own delay. A fast 200 takes a fixed step off it
+    (additive increase of the rate); a non-200, an error or a latency well
+    above the account's baseline multiplies it (multiplicative decrease).
+    With adaptive pacing off the delay is config.sleep_time for every account.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.pacers: Dict[str, AccountPacer] = {}
+
+    def _pacer(self, username: str) -> AccountPacer:
+        pacer = self.pacers.get(username)
+        if pacer is None:
+            pacer = AccountPacer(username, self.config.sleep_time)
+            self.pacers[username] = pacer
+        return pacer
+
+    def delay(self, username: str) -> float:
+        if not self.config.adaptive:
+            return self.config.sleep_time
+        return self._pacer(username).delay
+
+    def record_success(self, username: str, latency: float) -> float:
+        pacer = self._pacer(username)
+        if pacer.observe_latency(latency):
+            pacer.set_delay(
+                min(self.config.max_sleep_time, pacer.delay * 1.5), "latency rising"
+            )
+        else:
+            pacer.set_delay(
+                max(
+                    self.config.min_sleep_time, pacer.delay - self.config.adaptive_step
+                ),
+                "ok",
+            )
+        return self.delay(username)
+
+    def record_failure(self, username: str, reason: str) -> float:
+        pacer = self._pacer(username)
+        pacer.set_delay(min(self.config.max_sleep_time, pacer.delay * 2), reason)
+        return self.delay(username)
+
+    def reset(self):
+        """Start every account over from config.sleep_time, after a manual change"""
+        self.pacers = {}
+
+    def snapshot(self) -> List[dict]:
+        return [
+            {
+                "username": pacer.username,
+                "delay": self.delay(pacer.username),
+                "latency": pacer.latency,
+                "baseline": pacer.baseline,
+                "history": list(pacer.history),
+            }
+            for pacer in sorted(self.pacers.values(), key=lambda p: p.username)
+        ]
@@ -0,0 +1,264 @@
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import (
+    Column,
+    Float,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    and_,
+    create_engine,
+    event,
+    func,
+    or_,
+    select,
+)
+
+from database import set_sqlite_pragmas
+from output_formats import RECORD_SCHEMA
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class RecordStoreConfig:
+    """Where crawled records are also stored for queries, off unless RECORD_STORE=1"""
+
+    enabled = os.environ.get("RECORD_STORE", "0") == "1"
+    path = os.environ.get("RECORD_STORE_PATH", "records.db")
+    max_limit = 1000  # records per page of /api/records
+
+
+record_store_config = RecordStoreConfig()
+
+COLUMN_TYPES = {"string": String, "int": Integer, "float": Float, "timestamp": String}
+# timestamps stay "YYYY-MM-DD HH:MM:SS" text, which sorts and slices by hour
+
+metadata = MetaData()
+records_table = Table(
+    "records",
+    metadata,
+    Column("date", String, primary_key=True),
+    Column("country_code", String, primary_key=True),
+    *(
+        Column(name, COLUMN_TYPES[kind], primary_key=name == "id")
+        for name, kind in RECORD_SCHEMA
+    ),
+    Column("task_id", Integer),
+    Index("ix_records_sendTime", "sendTime"),
+    Index("ix_records_userName", "userName"),
+    Index("ix_records_smsTo", "smsTo"),
+    Index("ix_records_sendResult", "sendResult"),
+)
+
+# columns /api/records filters on by equality, and /api/records/stats groups by
+FILTER_COLUMNS = {
+    "date",
+    "country_code",
+    "userName",
+    "countryName",
+    "operator",
+    "smsFrom",
+    "smsTo",
+    "sendResult",
+    "gatewayName",
+    "currency",
+    "task_id",
+}
+INTERVALS = {"hour": 13, "day": 10}  # length of the sendTime prefix
+
+
+def _convert(kind: str, value):
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "int":
+            return int(value)
+        if kind == "float":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+class RecordStore:
+    """
+    Indexed SQLite copy of the crawled records, for queries without a download.
+
+    The engine hands over the records of every page it writes to the output;
+    they are inserted on one dedicated thread, one transaction per page, so
+    the spider never waits for them. Records are keyed by date, country and
+    id, so pages fetched again after a resume replace what they stored before.
+    Queries run on the thread pool and read through WAL while pages go in.
+    """
+
+    def __init__(self, config: RecordStoreConfig = record_store_config):
+        self.config = config
+        self.engine = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="record-store"
+        )
+        self.pending: Set[Future] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.enabled
+
+    def _connect(self):
+        if self.engine is None:
+            self.engine = create_engine(
+                f"sqlite:///{self.config.path}",
+                connect_args={"check_same_thread": False},
+            )
+            event.listen(self.engine, "connect", set_sqlite_pragmas)
+            metadata.create_all(self.engine)
+        return self.engine
+
+    def _insert(self, task_id: int, date: str, country_code: str, batch: List[dict]):
+        rows = []
+        for record in batch:
+            row = {
+                name: _convert(kind, record.get(name)) for name, kind in RECORD_SCHEMA
+            }
+            row.update(
+                id=str(record.get("id")),
+                date=date,
+                country_code=country_code,
+                task_id=task_id,
+                # keyset pagination needs a sendTime on every row
+                sendTime=row["sendTime"] or "",
+            )
+            rows.append(row)
+        with self._connect().begin() as conn:
+            conn.execute(records_table.insert().prefix_with("OR REPLACE"), rows)
+
+    def add(self, task_id: int, date: str, country_code: str, batch: List[dict]):
+        """Queue records of one page for insertion"""
+        if not batch:
+            return
+        future = self.executor.submit(self._insert, task_id, date, country_code, batch)
+        self.pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: Future):
+        self.pending.discard(future)
+        if future.exception() is not None:
+            logger.error(f"Error storing records: {str(future.exception())}")
+
+    async def flush(self):
+        """Wait until every queued page is stored"""
+        if self.pending:
+            await asyncio.gather(
+                *(asyncio.wrap_future(f) for f in list(self.pending)),
+                return_exceptions=True,
+            )
+
+    @staticmethod
+    def _where(filters: Dict[str, str], start_time: str, end_time: str) -> list:
+        conditions = [records_table.c[name] == value for name, value in filters.items()]
+        if start_time:
+            conditions.append(records_table.c.sendTime >= start_time)
+        if end_time:
+            conditions.append(records_table.c.sendTime < end_time)
+        return conditions
+
+    def _query(
+        self,
+        filters: Dict[str, str],
+        start_time: str,
+        end_time: str,
+        limit: int,
+        after: Optional[str],
+    ) -> dict:
+        table = records_table
+        conditions = self._where(filters, start_time, end_time)
+        if after:
+            # keyset: strictly older than the last record of the previous page
+            send_time, _, record_id = after.rpartition("|")
+            conditions.append(
+                or_(
+                    table.c.sendTime < send_time,
+                    and_(table.c.sendTime == send_time, table.c.id < record_id),
+                )
+            )
+        query = (
+            select(table)
+            .where(*conditions)
+            .order_by(table.c.sendTime.desc(), table.c.id.desc())
+            .limit(limit + 1)
+        )
+        with self._connect().connect() as conn:
+            rows = [dict(row._mapping) for row in conn.execute(query)]
+        following = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            following = f"{rows[-1]['sendTime']}|{rows[-1]['id']}"
+        return {"records": rows, "next": following}
+
+    def _stats(
+        self,
+        filters: Dict[str, str],
+        start_time: str,
+        end_time: str,
+        group_by: List[str],
+        interval: Optional[str],
+    ) -> dict:
+        table = records_table
+        keys = [table.c[name] for name in group_by]
+        if interval:
+            keys.insert(
+                0, func.substr(table.c.sendTime, 1, INTERVALS[interval]).label(interval)
+            )
+        query = (
+            select(
+                *keys,
+                func.count().label("count"),
+                func.sum(table.c.smsCount).label("sms_count"),
+                func.sum(table.c.smsFee).label("sms_fee"),
+            )
+            .where(*self._where(filters, start_time, end_time))
+            .group_by(*keys)
+            .order_by(*keys)
+        )
+        with self._connect().connect() as conn:
+            groups = [dict(row._mapping) for row in conn.execute(query)]
+        return {"groups": groups}
+
+    async def query(
+        self,
+        filters: Dict[str, str],
+        start_time: str = "",
+        end_time: str = "",
+        limit: int = 100,
+        after: Optional[str] = None,
+    ) -> dict:
+        """Records matching filters newest first, next is the after of the following page"""
+        limit = max(1, min(limit, self.config.max_limit))
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._query, filters, start_time, end_time, limit, after
+        )
+
+    async def stats(
+        self,
+        filters: Dict[str, str],
+        start_time: str = "",
+        end_time: str = "",
+        group_by: List[str] = (),
+        interval: Optional[str] = None,
+    ) -> dict:
+        """Record counts, SMS counts and fees grouped by columns and/or by hour or day"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._stats, filters, start_time, end_time, list(group_by), interval
+        )
+
+    async def close(self):
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
+
+record_store = RecordStore()
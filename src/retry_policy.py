@@ -0,0 +1,150 @@
+import asyncio
+import json
+import random
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import aiohttp
+
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# what went wrong with a request, each class has its own backoff
+OK = "ok"
+AUTH = "auth"  # token expired or account rejected, swap the account
+THROTTLE = "throttle"  # upstream asks us to slow down
+SERVER = "server"  # transient 5xx or an upstream failure reported in the body
+NETWORK = "network"  # timeouts, resets, DNS
+MALFORMED = "malformed"  # a body we cannot use or a request upstream refuses
+
+
+def classify(
+    status: Optional[int] = None,
+    error: Optional[BaseException] = None,
+    payload: Optional[dict] = None,
+) -> str:
+    """Map the outcome of one request to an error class"""
+    if error is not None:
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+            return NETWORK
+        if isinstance(error, aiohttp.ClientPayloadError):
+            return NETWORK
+        if isinstance(error, (json.JSONDecodeError, ValueError, KeyError, TypeError)):
+            return MALFORMED
+        if isinstance(error, aiohttp.ClientError):
+            return NETWORK
+        return MALFORMED
+    if status is not None and status != 200:
+        if status in (401, 403):
+            return AUTH
+        if status == 429:
+            return THROTTLE
+        if status >= 500:
+            return SERVER
+        return MALFORMED
+    if payload is not None and payload.get("success") is False:
+        # the API reports some failures with HTTP 200 and a code in the body
+        code = payload.get("code")
+        if code in (401, 403):
+            return AUTH
+        if code == 429:
+            return THROTTLE
+        return SERVER
+    return OK
+
+
+class BackoffRule:
+    """Exponential backoff with full jitter and a retry budget for one error class"""
+
+    def __init__(self, base: float, cap: float, retries: int, factor: float = 2):
+        self.base = base
+        self.cap = cap
+        self.retries = retries
+        self.factor = factor
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * self.factor**attempt))
+
+
+class RetryExhausted(Exception):
+    """A request kept failing past the retry budget of its error class"""
+
+    def __init__(self, error_class: str, attempts: int, detail: str = ""):
+        self.error_class = error_class
+        self.attempts = attempts
+        self.detail = detail
+        super().__init__(
+            f"{error_class} error after {attempts} attempts"
+            + (f": {detail}" if detail else "")
+        )
+
+
+class RetryPolicy:
+    """
+    Per-error-class retry decisions shared by the spider and account login.
+
+    Callers that retry across accounts (the spider) ask should_retry() and
+    delay() themselves; simple request sequences use run().
+    """
+
+    def __init__(self, rules: Dict[str, BackoffRule]):
+        self.rules = rules
+
+    def should_retry(self, error_class: str, attempt: int) -> bool:
+        """attempt counts the failures of this class so far, starting at 1"""
+        rule = self.rules.get(error_class)
+        return rule is not None and attempt <= rule.retries
+
+    def delay(self, error_class: str, attempt: int) -> float:
+        rule = self.rules.get(error_class)
+        return rule.delay(attempt) if rule is not None else 0
+
+    async def run(
+        self, attempt_fn: Callable[[], Awaitable[Tuple[str, Any]]], label: str
+    ) -> Any:
+        """
+        Call attempt_fn until it reports OK, sleeping the class backoff between tries.
+
+        attempt_fn returns (error_class, value); exceptions it raises are
+        classified too. Raises RetryExhausted once a class is out of budget.
+        """
+        failures: Dict[str, int] = {}
+        while True:
+            detail = ""
+            try:
+                error_class, value = await attempt_fn()
+            except Exception as e:
+                error_class, value, detail = classify(error=e), None, str(e)
+            if error_class == OK:
+                return value
+            failures[error_class] = failures.get(error_class, 0) + 1
+            attempt = failures[error_class]
+            if not self.should_retry(error_class, attempt):
+                raise RetryExhausted(error_class, sum(failures.values()), detail)
+            delay = self.delay(error_class, attempt)
+            logger.warning(
+                f"{label}: {error_class} error {detail}, retry {attempt} in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+# the spider swaps accounts on auth errors, so those budgets count accounts tried
+spider_retry_policy = RetryPolicy(
+    {
+        AUTH: BackoffRule(base=0, cap=0, retries=10),
+        THROTTLE: BackoffRule(base=30, cap=900, retries=12),
+        SERVER: BackoffRule(base=5, cap=300, retries=10),
+        NETWORK: BackoffRule(base=2, cap=120, retries=10),
+        MALFORMED: BackoffRule(base=5, cap=60, retries=3),
+    }
+)
+
+# a wrong password is an auth error and is not worth repeating
+login_retry_policy = RetryPolicy(
+    {
+        THROTTLE: BackoffRule(base=10, cap=120, retries=3),
+        SERVER: BackoffRule(base=1, cap=30, retries=3),
+        NETWORK: BackoffRule(base=1, cap=30, retries=3),
+        MALFORMED: BackoffRule(base=1, cap=10, retries=2),
+    }
+)
@@ -13,8 +13,8 @@ async def create_daily_task():
     # Get yesterday's date in Hong Kong time
     yesterday = (datetime.now(hong_kong_tz) - timedelta(days=1)).strftime("%Y-%m-%d")
 
-    # Create task for yesterday
-    task = await task_manager.create_task(yesterday)
+    # Create task for yesterday, a re-run of the day only fetches what is new
+    task = await task_manager.create_task(yesterday, incremental=True)
 
     # Start the task automatically
     if task:
@@ -23,9 +23,9 @@ async def create_daily_task():
 
 async def auto_stop_last_task():
     """Stop the last task if it's running at 09:00 Hong Kong time"""
-    tasks = task_manager.get_tasks()
-    if tasks:
-        last_task = tasks[0]
+    # the daily task, tasks of crawl plans are left to their plan
+    last_task = task_manager.get_last_task()
+    if last_task:
         await task_manager.stop_task(last_task.id)  # type: ignore
 
 
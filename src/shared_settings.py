@@ -0,0 +1,29 @@
+import json
+from typing import Dict
+
+from database import SessionLocal, SettingDB
+from db_writer import db_writer
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+def read_settings() -> Dict[str, dict]:
+    """Every stored setting by name"""
+    session = SessionLocal()
+    try:
+        settings = {}
+        for row in session.query(SettingDB).all():
+            try:
+                settings[row.name] = json.loads(row.value)
+            except ValueError:
+                logger.error(f"Ignoring unreadable setting {row.name}: {row.value}")
+        return settings
+    finally:
+        session.close()
+
+
+async def save_setting(name: str, value: dict):
+    """Store a setting for every process, the workers apply it on their next round"""
+    text = json.dumps(value)
+    await db_writer.run(lambda session: session.merge(SettingDB(name=name, value=text)))
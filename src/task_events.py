@@ -0,0 +1,183 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from database import SessionLocal, TaskDB
+from leases import active_task_ids, worker_config
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class TaskEventsConfig:
+    """How /task/events streams progress"""
+
+    poll_interval = 2  # seconds between reads of the running tasks in web mode
+    min_interval = 0.5  # seconds between two events of one stream, bursts coalesce
+    keepalive = 15  # seconds of silence before a comment line keeps proxies open
+    max_age = 300  # seconds a stream lives, the browser reconnects on its own
+    finished_ttl = 60  # seconds a finished task is still sent to new streams
+
+
+task_events_config = TaskEventsConfig()
+
+PROGRESS_FIELDS = (
+    "current_page",
+    "total_page",
+    "rows",
+    "duplicates",
+    "expected_rows",
+    "error",
+)
+
+
+def task_status(task) -> str:
+    """The status label the task list shows"""
+    if task.done:
+        return "Completed"
+    if task.queued:
+        return "Queued"
+    if task.error:
+        return "Failed"
+    if task.stop_flag:
+        return "Stopped"
+    return "Running"
+
+
+class TaskProgressHub:
+    """
+    Latest progress of the running tasks, pushed to every /task/events stream.
+
+    Engines of this process publish after every page they commit. In web
+    mode the engines run in worker processes, so while anybody listens one
+    poller reads the rows of the running tasks every poll_interval seconds;
+    the database sees the same load for one open task page as for twenty.
+    A stream sends the tasks that changed since its last event, so a slow
+    client gets the newest state rather than a backlog.
+    """
+
+    def __init__(self, config: TaskEventsConfig = task_events_config):
+        self.config = config
+        self.tasks: Dict[int, dict] = {}
+        self.version = 0
+        self.subscribers: Set[asyncio.Event] = set()
+        self.poller: Optional[asyncio.Future] = None
+
+    def publish(self, task_id: int, **fields):
+        """Record progress of a task, a no-op when nothing changed"""
+        state = self.tasks.get(task_id)
+        if state is None:
+            state = self.tasks[task_id] = {"id": task_id, "rows_per_s": None}
+        elif all(state.get(name) == value for name, value in fields.items()):
+            return
+        now = time.monotonic()
+        if "rows" in fields:
+            self._sample_rate(state, fields["rows"], now)
+        state.update(fields)
+        if state.get("status") != "Running":
+            state["rows_per_s"] = None
+            state.setdefault("finished", now)
+        else:
+            state.pop("finished", None)
+        self.version += 1
+        state["version"] = self.version
+        self._prune(now)
+        for event in self.subscribers:
+            event.set()
+
+    @staticmethod
+    def _sample_rate(state: dict, rows: int, now: float):
+        # rows/s over at least a second, smoothed over the last few seconds
+        sampled_at, sampled_rows = state.get("sample", (now, rows))
+        if rows < sampled_rows:
+            sampled_at, sampled_rows = now, rows
+        if now - sampled_at >= 1:
+            rate = (rows - sampled_rows) / (now - sampled_at)
+            last = state.get("rows_per_s")
+            state["rows_per_s"] = round(rate if last is None else (last + rate) / 2)
+            sampled_at, sampled_rows = now, rows
+        state["sample"] = (sampled_at, sampled_rows)
+
+    def _prune(self, now: float):
+        for task_id in [
+            task_id
+            for task_id, state in self.tasks.items()
+            if now - state.get("finished", now) > self.config.finished_ttl
+        ]:
+            del self.tasks[task_id]
+
+    @staticmethod
+    def _read(known: Set[int]) -> List[dict]:
+        # tasks running now, and the ones seen running whose end is not known yet
+        task_ids = known | set(active_task_ids())
+        if not task_ids:
+            return []
+        session = SessionLocal()
+        try:
+            progress = []
+            for task in session.query(TaskDB).filter(TaskDB.id.in_(task_ids)):
+                fields = {name: getattr(task, name) for name in PROGRESS_FIELDS}
+                fields["id"] = task.id
+                fields["status"] = task_status(task)
+                progress.append(fields)
+            return progress
+        finally:
+            session.close()
+
+    async def _poll_loop(self):
+        while self.subscribers:
+            known = {
+                task_id
+                for task_id, state in self.tasks.items()
+                if state.get("status") == "Running"
+            }
+            try:
+                for fields in await asyncio.get_running_loop().run_in_executor(
+                    None, self._read, known
+                ):
+                    self.publish(fields.pop("id"), **fields)
+            except Exception as e:
+                logger.error(f"Error reading task progress: {str(e)}")
+            await asyncio.sleep(self.config.poll_interval)
+
+    def _ensure_poller(self):
+        # engines of this process publish themselves
+        if worker_config.local_spiders:
+            return
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.ensure_future(self._poll_loop())
+
+    def _event(self, state: dict) -> str:
+        data = {k: v for k, v in state.items() if k not in ("sample", "finished")}
+        return f"data: {json.dumps(data)}\n\n"
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Server-sent events of task progress, starting with every known task"""
+        changed = asyncio.Event()
+        self.subscribers.add(changed)
+        self._ensure_poller()
+        sent = 0
+        started = time.monotonic()
+        try:
+            yield f"retry: {self.config.poll_interval * 1000}\n\n"
+            while time.monotonic() - started < self.config.max_age:
+                changed.clear()
+                version = self.version
+                for state in list(self.tasks.values()):
+                    if state["version"] > sent:
+                        yield self._event(state)
+                sent = version
+                try:
+                    await asyncio.wait_for(
+                        changed.wait(), timeout=self.config.keepalive
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                await asyncio.sleep(self.config.min_interval)
+        finally:
+            self.subscribers.discard(changed)
+
+
+task_progress = TaskProgressHub()
@@ -1,22 +1,37 @@
 import asyncio
-from database import TaskDB, SessionLocal, AccountDB
+from typing import Dict, List, Optional
+from sqlalchemy import func
+from database import DEFAULT_COUNTRY_CODE, TaskDB, TaskCheckpointDB, SessionLocal
 from datetime import datetime
 import os
 from utils.logger_config import get_logger
-import csv
-import aiohttp
-import time
-from typing import Optional
+from fetch_engine import PageFetchEngine
+from rate_controller import RateController
+from db_writer import db_writer
+from leases import RECLAIM_NOW, active_task_ids, live_workers, worker_config
+from output_formats import (
+    DEFAULT_OUTPUT_FORMAT,
+    available_formats,
+    copy_output,
+    create_output,
+    output_path,
+)
+from shared_settings import save_setting
 
 logger = get_logger(__name__)
 
 
-# Make spider_sleep_time global and mutable
+# Make spider_sleep_time global and mutable, it paces each account separately
 class SpiderConfig:
-    sleep_time = 180
+    sleep_time = 180  # starting delay of every account, or the fixed one
+    adaptive = True  # let the rate controller tune the delay per account
+    min_sleep_time = 5
+    max_sleep_time = 900
+    adaptive_step = 5  # seconds taken off the delay after a fast 200
 
 
 spider_config = SpiderConfig()
+rate_controller = RateController(spider_config)
 
 
 async def spider_task(task_id: int):
@@ -25,168 +40,284 @@ async def spider_task(task_id: int):
     Args:
         task_id: The ID of the task to run
     """
-    session = SessionLocal()
     try:
-        task = session.query(TaskDB).get(task_id)
-        if not task:
-            logger.error(f"Task {task_id} not found")
-            return
-
-        base_url = "https://web.antgst.com/antgst/sms/otpPremium/channel/sendRecordList"
-
-        while not task.stop_flag and task.current_page < task.total_page:
-            # Get an available account
-            account = (
-                session.query(AccountDB)
-                .filter(AccountDB.is_active == True, AccountDB.is_online == True)
-                .first()
-            )
-            if not account:
-                logger.error("No available account")
-                await asyncio.sleep(60)
-                continue
-
-            try:
-                # Prepare request parameters
-                timestamp = int(time.time() * 1000)
-                params = {
-                    "_t": timestamp,
-                    "day": task.date,
-                    "countryCode": "0055",
-                    "column": "createTime",
-                    "order": "desc",
-                    "field": "id,,userName,countryName,operator,smsFrom,smsTo,message,sendResult,gatewayDr,gatewayRealDr,intervalTime,smsCount,smsFee,currency,sendDrStatus,resendDrTimes,sendTime,updateTime,gatewayName,gatewayResult,validateResult,action",
-                    "pageNo": task.current_page,
-                    "pageSize": 3000,
-                }
-                headers = {"X-Access-Token": str(account.token)}
-
-                async with aiohttp.ClientSession() as client:
-                    async with client.get(
-                        base_url, params=params, headers=headers
-                    ) as response:
-
-                        if response.status == 200:
-                            data = await response.json()
-
-                            # Write data to CSV file
-                            with open(task.data_file_path, "a", newline="") as f:
-                                writer = csv.writer(f)
-                                for record in data.get("result", {}).get("records", []):
-                                    writer.writerow(
-                                        [
-                                            record.get("id"),
-                                            record.get("userName"),
-                                            record.get("countryName"),
-                                            record.get("operator"),
-                                            record.get("smsFrom"),
-                                            record.get("smsTo"),
-                                            record.get("message"),
-                                            record.get("sendResult"),
-                                            record.get("sendTime"),
-                                        ]
-                                    )
-
-                            # Update task progress
-                            task.current_page += 1
-                            task.total_page = data.get("result", {}).get("pages", 0)
-                            session.commit()
-                            logger.info(
-                                f"Task {task_id} completed page {task.current_page}"
-                            )
-                        else:
-                            setattr(account, "is_online", False)
-                            session.commit()
-                            logger.error(
-                                f"Request failed with status {response.status}"
-                            )
-                            break
-
-                await asyncio.sleep(
-                    spider_config.sleep_time
-                )  # Use the configurable sleep time
-
-            except Exception as e:
-                logger.error(f"Error in spider task: {str(e)}")
-                await asyncio.sleep(5)  # Wait before retrying on error
-
-        # Mark task as done if completed
-        if task.current_page >= task.total_page:
-            task.done = True
-            session.commit()
-
+        # pages are spread over every online account, each paced on its own
+        await PageFetchEngine(task_id, rate_controller).run()
     except Exception as e:
         logger.error(f"Fatal error in spider task: {str(e)}")
-    finally:
-        session.close()
 
 
 class TaskManager:
+    # spider futures of this process by task id, shared by every TaskManager
+    running = {}
+    # the stored pacing change this process applied last
+    pacing_changed_at: Optional[str] = None
+
     def __init__(self):
         self.session = SessionLocal()
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
 
-    async def create_task(self, date: str):
+    def _incremental_base(
+        self, date: str, country_code: str, output_format: str
+    ) -> Optional[TaskDB]:
+        """The last complete crawl of a date and country an incremental task can continue"""
+        tasks = (
+            self.session.query(TaskDB)
+            .filter(
+                TaskDB.date == date,
+                TaskDB.country_code == country_code,
+                TaskDB.output_format == output_format,
+                TaskDB.done == True,
+                TaskDB.watermark_time != None,
+            )
+            .order_by(TaskDB.id.desc())
+            .populate_existing()
+            .all()
+        )
+        return next(
+            (task for task in tasks if os.path.exists(str(task.data_file_path))), None
+        )
+
+    async def create_task(
+        self,
+        date: str,
+        output_format: str = DEFAULT_OUTPUT_FORMAT,
+        incremental: bool = False,
+        country_code: str = DEFAULT_COUNTRY_CODE,
+    ):
+        """
+        Create a stopped task. An incremental task continues the output of the
+        last complete crawl of the same date, country and format and only
+        fetches the records newer than it; without one it crawls everything.
+        """
+        if output_format not in available_formats():
+            raise ValueError(f"Unsupported output format: {output_format}")
+        base = (
+            self._incremental_base(date, country_code, output_format)
+            if incremental
+            else None
+        )
         task = TaskDB(
             date=date,
+            country_code=country_code,
             stop_flag=True,
             done=False,
             created_at=datetime.now(),
-            data_file_path=os.path.join(
-                self.output_dir,
-                f"data_{date}_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv",
+            output_format=output_format,
+            data_file_path=output_path(
+                self.output_dir, date, output_format, country_code
             ),
         )
-        # create the task result null file
-        with open(str(task.data_file_path), "w") as f:
-            f.write("")
+        checkpoint = None
+        if base is None:
+            # create the task result null file
+            create_output(str(task.data_file_path), output_format)
+        else:
+            # the new records are added to a copy, the base output stays as it is
+            offset = await asyncio.get_running_loop().run_in_executor(
+                None,
+                copy_output,
+                str(base.data_file_path),
+                str(task.data_file_path),
+                output_format,
+            )
+            task.base_task_id = base.id
+            task.watermark_time = base.watermark_time
+            task.watermark_ids = base.watermark_ids
+            last = (
+                self.session.query(TaskCheckpointDB)
+                .filter(TaskCheckpointDB.task_id == base.id)
+                .order_by(TaskCheckpointDB.id.desc())
+                .first()
+            )
+            checkpoint = TaskCheckpointDB(
+                page=0, offset=offset, rows=last.rows if last else 0
+            )
+            logger.info(
+                f"Incremental task for {date} continues task {base.id} "
+                f"after {base.watermark_time}"
+            )
+
+        def add(session):
+            session.add(task)
+            session.flush()
+            if checkpoint is not None:
+                # resuming cuts the output back to the copy, never further
+                checkpoint.task_id = task.id
+                session.add(checkpoint)
+            return task.id
+
+        task_id = await db_writer.run(add)
+        return self.session.get(TaskDB, task_id)  # Return the task object
+
+    def get_tasks(self, limit: int, offset: int = 0) -> List[TaskDB]:
+        """One page of tasks, newest first; LIMIT/OFFSET walk the created_at index"""
+        return (
+            self.session.query(TaskDB)
+            .order_by(TaskDB.created_at.desc(), TaskDB.id.desc())
+            .offset(offset)
+            .limit(limit)
+            .populate_existing()
+            .all()
+        )
+
+    def count_tasks(self) -> int:
+        return self.session.query(func.count(TaskDB.id)).scalar()
+
+    def get_last_task(self, include_plans: bool = False) -> Optional[TaskDB]:
+        """The newest task, by default only among tasks outside crawl plans"""
+        query = self.session.query(TaskDB)
+        if not include_plans:
+            query = query.filter(TaskDB.plan_id == None)
+        return (
+            query.order_by(TaskDB.created_at.desc(), TaskDB.id.desc())
+            .populate_existing()
+            .first()
+        )
 
-        self.session.add(task)
-        self.session.commit()
-        return task  # Return the task object
+    async def _set_task(self, task_id: int, **fields) -> bool:
+        """Update a task on the writer thread, False when it does not exist"""
+        updated = await db_writer.run(
+            lambda session: session.query(TaskDB)
+            .filter(TaskDB.id == task_id)
+            .update(fields)
+        )
+        return bool(updated)
+
+    @staticmethod
+    def running_ids() -> List[int]:
+        """Spider tasks running in this process, or on every worker in worker mode"""
+        if not worker_config.local_spiders:
+            return active_task_ids()
+        return [
+            task_id
+            for task_id, future in TaskManager.running.items()
+            if not future.done()
+        ]
 
-    def get_tasks(self):
-        return self.session.query(TaskDB).order_by(TaskDB.created_at.desc()).all()
+    @staticmethod
+    def running_count() -> int:
+        return len(TaskManager.running_ids())
 
     async def start_task(self, task_id: int):
-        task = self.session.query(TaskDB).get(task_id)
-        if task:
-            task.stop_flag = False
-            self.session.commit()
+        if not worker_config.local_spiders:
+            # a worker process claims it on its next round
+            return await self._set_task(
+                task_id,
+                stop_flag=False,
+                error=None,
+                queued=False,
+                lease_expires=RECLAIM_NOW,
+            )
+        if await self._set_task(task_id, stop_flag=False, error=None, queued=False):
+            running = TaskManager.running.get(task_id)
+            if running is not None and not running.done():
+                # a second engine would write the same output file
+                logger.info(f"Task {task_id} is already running")
+                return True
             # use the asyncio.ensure_future to run the task in the background
             # the task is the spider task
-            asyncio.ensure_future(spider_task(task_id))
+            TaskManager.running[task_id] = asyncio.ensure_future(spider_task(task_id))
 
             return True
         return False
 
+    async def resume_unfinished_tasks(self):
+        """Restart the tasks a previous process left running, from their checkpoints"""
+        tasks = (
+            self.session.query(TaskDB)
+            .filter(TaskDB.done == False, TaskDB.stop_flag == False)
+            .populate_existing()
+            .all()
+        )
+        for task in tasks:
+            logger.info(f"Resuming unfinished task {task.id} ({task.date})")
+            await self.start_task(task.id)  # type: ignore
+        return len(tasks)
+
     async def stop_task(self, task_id: int):
-        task = self.session.query(TaskDB).get(task_id)
-        if task:
-            task.stop_flag = True
-            self.session.commit()
-            return True
-        return False
+        # a queued task of a crawl plan is taken out of the queue as well
+        return await self._set_task(task_id, stop_flag=True, queued=False)
 
     async def update_progress(self, task_id: int, current_page: int):
-        task = self.session.query(TaskDB).get(task_id)
-        if task:
+        def update(session):
+            task = session.get(TaskDB, task_id)
+            if not task:
+                return False
             task.current_page = current_page
             if current_page >= task.total_page:
                 task.done = True
-            self.session.commit()
             return True
-        return False
+
+        return await db_writer.run(update)
 
     @staticmethod
-    async def update_sleep_time(sleep_time: int):
-        """Update the spider sleep time"""
+    async def update_sleep_time(sleep_time: int, adaptive: bool = True):
+        """Update the spider sleep time, adaptive pacing starts over from it"""
         if sleep_time > 0:
-            spider_config.sleep_time = sleep_time
+            pacing = {
+                "sleep_time": sleep_time,
+                "adaptive": adaptive,
+                "changed_at": datetime.now().isoformat(),
+            }
+            TaskManager._apply_pacing(pacing)
+            # the workers of web mode take it from the database
+            await save_setting("pacing", pacing)
             return True
         return False
 
+    @staticmethod
+    def _apply_pacing(pacing: dict):
+        spider_config.sleep_time = pacing["sleep_time"]
+        spider_config.adaptive = pacing["adaptive"]
+        rate_controller.reset()
+        TaskManager.pacing_changed_at = pacing["changed_at"]
+
+    @staticmethod
+    def apply_settings(settings: Dict[str, dict]):
+        """Take a pacing change stored by another process, once"""
+        pacing = settings.get("pacing")
+        if pacing and pacing.get("changed_at") != TaskManager.pacing_changed_at:
+            logger.info(
+                f"Pacing changed to {pacing['sleep_time']}s, "
+                f"adaptive {pacing['adaptive']}"
+            )
+            TaskManager._apply_pacing(pacing)
+
     def get_spider_sleep_time(self):
         """Get the current spider sleep time"""
         return spider_config.sleep_time
+
+    def get_spider_config(self):
+        return spider_config
+
+    def get_pacing(self):
+        """Current delay of every account and how it changed"""
+        if worker_config.local_spiders:
+            return rate_controller.snapshot()
+        # SPIDER_MODE=web: the workers pace their accounts and report them
+        pacing = []
+        for state in live_workers().values():
+            for pacer in state.get("pacing", []):
+                pacer["history"] = [
+                    (datetime.fromisoformat(changed_at), delay, reason)
+                    for changed_at, delay, reason in pacer["history"]
+                ]
+                pacing.append(pacer)
+        return sorted(pacing, key=lambda pacer: pacer["username"])
+
+    @staticmethod
+    def pacing_state(usernames: List[str]) -> List[dict]:
+        """The pacing of the given accounts in JSON form, as a worker reports it"""
+        return [
+            dict(
+                pacer,
+                history=[
+                    (changed_at.isoformat(), delay, reason)
+                    for changed_at, delay, reason in pacer["history"]
+                ],
+            )
+            for pacer in rate_controller.snapshot()
+            if pacer["username"] in usernames
+        ]
@@ -0,0 +1,66 @@
+from typing import Iterable, List, Optional
+
+
+def record_time(record: dict) -> Optional[str]:
+    """When a record was created; "YYYY-MM-DD HH:MM:SS" strings sort by time"""
+    return record.get("createTime") or record.get("sendTime")
+
+
+class Watermark:
+    """
+    The newest record time stored for a date and country, and the ids stored
+    at exactly that time.
+
+    sendRecordList is sorted by createTime desc, so once a page holds a record
+    at or below the watermark every later page is stored already. The ids
+    tell apart records created in the same second as the watermark.
+    """
+
+    def __init__(self, newest: Optional[str] = None, ids: Iterable[str] = ()):
+        self.newest = newest
+        self.ids = set(ids)
+
+    @classmethod
+    def of_task(cls, task) -> "Watermark":
+        ids = task.watermark_ids.split(",") if task.watermark_ids else []
+        return cls(task.watermark_time, ids)
+
+    def seen(self, record: dict) -> bool:
+        """True when the record is at or below the watermark, i.e. stored already"""
+        created = record_time(record)
+        if self.newest is None or created is None:
+            return False
+        if created != self.newest:
+            return created < self.newest
+        return str(record.get("id")) in self.ids
+
+    def observe(self, records: List[dict]):
+        for record in records:
+            created = record_time(record)
+            if created is None:
+                continue
+            if self.newest is None or created > self.newest:
+                self.newest = created
+                self.ids = set()
+            if created == self.newest:
+                self.ids.add(str(record.get("id")))
+
+    def merge(self, other: "Watermark") -> bool:
+        """Move up to another watermark, returns True when this one changed"""
+        if other.newest is None:
+            return False
+        if self.newest is None or other.newest > self.newest:
+            self.newest = other.newest
+            self.ids = set(other.ids)
+            return True
+        if other.newest == self.newest and not other.ids <= self.ids:
+            self.ids |= other.ids
+            return True
+        return False
+
+    def fields(self) -> dict:
+        """The TaskDB columns holding this watermark"""
+        return {
+            "watermark_time": self.newest,
+            "watermark_ids": ",".join(sorted(self.ids)) or None,
+        }
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import signal
+from typing import Optional
+
+from account import AccountManager
+from account_pool import account_pool
+from crawl_planner import CrawlPlanner
+from db_writer import db_writer
+from fetch_engine import PageFetchEngine
+from http_client import http_client
+from ingest import page_decoder
+from leases import (
+    LEADER,
+    account_owner,
+    acquire_lease,
+    claim_task,
+    claimable_task_ids,
+    live_workers,
+    release_lease,
+    release_task,
+    renew_task_leases,
+    worker_config,
+    worker_lease,
+)
+from metrics import monitor_event_loop_lag
+from scheduler import scheduler, start_scheduler
+from shared_settings import read_settings
+from task_manager import TaskManager, spider_task
+from utils.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class SpiderWorker:
+    """
+    A process that runs spider tasks for web processes started in web mode.
+
+    Every round it renews its leases, claims started tasks nobody holds (up
+    to worker_config.max_tasks) and runs them like the web app would. A task
+    whose lease runs out, because its worker died or stalled, is claimed by
+    another worker and resumes from its checkpoint. The web app only writes
+    stop_flag, which the engine polls, so stopping works across processes.
+
+    One worker holds the leader lease and runs what must run once: the daily
+    scheduler, the crawl planner and the account health checks. The others
+    take the accounts other processes log in or check from the database.
+    Every worker spiders with its own share of the online accounts, so each
+    account is paced by one worker, and takes the settings changed in the
+    web app from the database.
+    """
+
+    def __init__(self):
+        self.worker_id = worker_config.worker_id
+        self.task_manager = TaskManager()
+        self.account_manager = AccountManager(start_health_check=False)
+        self.crawl_planner = CrawlPlanner(self.task_manager)
+        self.planner: Optional[asyncio.Future] = None
+        self.leader = False
+        self.stopping = False
+
+    def _local_tasks(self):
+        return {
+            task_id: future
+            for task_id, future in TaskManager.running.items()
+            if not future.done()
+        }
+
+    async def _run_task(self, task_id: int):
+        try:
+            await spider_task(task_id)
+        finally:
+            # an unfinished task (error, lost accounts) is not claimed again at
+            # once, unless this worker is shutting down
+            delay = 0 if self.stopping else worker_config.reclaim_delay
+            await release_task(task_id, self.worker_id, delay)
+
+    def _lead(self):
+        logger.info(f"Worker {self.worker_id} is the leader")
+        if scheduler.running:
+            scheduler.resume()
+        else:
+            start_scheduler()
+        self.planner = asyncio.ensure_future(self.crawl_planner.run())
+        self.account_manager.start_health_check_task()
+        self.account_manager.start_token_refresh_task()
+
+    def _step_down(self):
+        logger.info(f"Worker {self.worker_id} is no longer the leader")
+        scheduler.pause()
+        if self.planner is not None:
+            self.planner.cancel()
+            self.planner = None
+        self.account_manager.stop_health_check_task()
+        self.account_manager.stop_token_refresh_task()
+
+    async def heartbeat(self):
+        """Renew the leases of this worker and follow the leader election"""
+        leader = await acquire_lease(LEADER, self.worker_id, worker_config.lease_ttl)
+        if leader and not self.leader:
+            self._lead()
+        elif self.leader and not leader:
+            self._step_down()
+        self.leader = leader
+
+        running = self._local_tasks()
+        held = await renew_task_leases(self.worker_id, list(running))
+        for task_id, future in running.items():
+            if task_id not in held:
+                # another worker took over, two engines must not share an output
+                logger.error(f"Lease of task {task_id} lost, stopping it here")
+                for engine in PageFetchEngine.running:
+                    if engine.task_id == task_id:
+                        engine.abandon()
+                future.cancel()
+
+        await self.share_accounts()
+
+        settings = read_settings()
+        self.task_manager.apply_settings(settings)
+        self.crawl_planner.apply_settings(settings)
+
+        # logins, health checks and 401s of other processes arrive through the
+        # database; this process' own changes are written first
+        await db_writer.flush()
+        account_pool.reload()
+
+    async def share_accounts(self):
+        """Report this worker and take its share of the accounts"""
+        pacing = TaskManager.pacing_state(account_pool.usernames())
+        await acquire_lease(
+            worker_lease(self.worker_id),
+            self.worker_id,
+            worker_config.lease_ttl,
+            json.dumps({"pacing": pacing, "tasks": len(self._local_tasks())}),
+        )
+        # the workers running tasks split the accounts between them, so every
+        # account is paced by one of them; an idle worker keeps none
+        workers = live_workers()
+        busy = [worker for worker, state in workers.items() if state.get("tasks")]
+        owners = busy or list(workers)
+        account_pool.assign(
+            lambda username: account_owner(username, owners) == self.worker_id
+        )
+
+    async def claim_tasks(self) -> int:
+        """Start the tasks waiting for a worker while there are free slots"""
+        free = worker_config.max_tasks - len(self._local_tasks())
+        if free <= 0:
+            return 0
+        started = 0
+        for task_id in claimable_task_ids(self.worker_id, free):
+            if task_id in self._local_tasks() or not await claim_task(
+                task_id, self.worker_id
+            ):
+                continue
+            logger.info(f"Worker {self.worker_id} claimed task {task_id}")
+            TaskManager.running[task_id] = asyncio.ensure_future(
+                self._run_task(task_id)
+            )
+            started += 1
+        if started:
+            # an idle worker had no accounts, its new tasks need its share now
+            await self.share_accounts()
+            account_pool.reload()
+        return started
+
+    async def run(self):
+        logger.info(
+            f"Worker {self.worker_id} started, up to {worker_config.max_tasks} tasks"
+        )
+        await http_client.start()
+        lag_monitor = asyncio.ensure_future(monitor_event_loop_lag())
+        try:
+            while True:
+                try:
+                    await self.heartbeat()
+                    await self.claim_tasks()
+                except Exception as e:
+                    logger.error(f"Error in worker round: {str(e)}")
+                await asyncio.sleep(worker_config.poll_interval)
+        finally:
+            lag_monitor.cancel()
+            await self.shutdown()
+
+    async def shutdown(self):
+        """Stop the running engines at their checkpoints and hand everything back"""
+        self.stopping = True
+        if self.leader:
+            self._step_down()
+        running = self._local_tasks()
+        for future in running.values():
+            future.cancel()
+        await asyncio.gather(*running.values(), return_exceptions=True)
+        if self.leader:
+            await release_lease(LEADER, self.worker_id)
+        # the other workers take over this one's accounts on their next round
+        await release_lease(worker_lease(self.worker_id), self.worker_id)
+        await self.account_manager.cleanup()
+        await http_client.close()
+        await db_writer.close()
+        page_decoder.close()
+
+
+async def main():
+    worker_config.mode = "worker"
+    worker = SpiderWorker()
+    run = asyncio.ensure_future(worker.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, run.cancel)
+    try:
+        await run
+    except asyncio.CancelledError:
+        pass
+    logger.info(f"Worker {worker_config.worker_id} stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"
+)
+sys.path.insert(0, SRC_DIR)
+
+# database.py opens spider.db in the working directory when it is imported,
+# the tests get a scratch one instead of the real database
+os.chdir(tempfile.mkdtemp(prefix="spider-tests-"))
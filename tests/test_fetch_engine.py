@@ -0,0 +1,179 @@
+import asyncio
+import os
+import threading
+from datetime import datetime
+
+import pytest
+from aiohttp.test_utils import TestServer
+
+import fetch_engine
+from account_pool import PooledAccount, account_pool
+from database import SessionLocal, TaskCheckpointDB, TaskDB
+from db_writer import db_writer
+from bench.mock_antgst import MockAntgst, MockConfig, token_for
+from fetch_engine import FetchedPage, PageFetchEngine
+from http_client import http_client
+from ingest import PageSpool, page_decoder
+from output_formats import create_output, read_output_ids
+from rate_controller import RateController
+from retry_policy import OK
+from watermark import Watermark
+
+PAGES = 12
+ROWS = 50  # per page
+
+
+class Pacing:
+    sleep_time = 0
+    adaptive = False
+    min_sleep_time = 0
+    max_sleep_time = 0
+    adaptive_step = 0
+
+
+def page_records(page: int):
+    return [
+        {"id": f"{page}-{i}", "sendTime": "2024-01-01 00:00:00"} for i in range(ROWS)
+    ]
+
+
+async def fake_fetch(engine, account, page):
+    await asyncio.sleep(0.02)
+    spool = PageSpool()
+    spool.write(page_records(page))
+    return OK, "", FetchedPage(spool, PAGES, PAGES * ROWS, Watermark(), False)
+
+
+@pytest.fixture
+def task_id(tmp_path):
+    path = str(tmp_path / "data.csv")
+    create_output(path, "csv")
+    session = SessionLocal()
+    task = TaskDB(
+        date="2024-01-01",
+        stop_flag=False,
+        done=False,
+        created_at=datetime.now(),
+        output_format="csv",
+        data_file_path=path,
+    )
+    session.add(task)
+    session.commit()
+    task_id = task.id
+    session.close()
+    return task_id
+
+
+def fill_pool(accounts: int):
+    account_pool.changed = asyncio.Event()
+    account_pool.loaded = True
+    account_pool.accounts = {
+        f"user{i}": PooledAccount(f"user{i}", f"token{i}") for i in range(accounts)
+    }
+
+
+def test_lease_taken_over_mid_run(task_id, monkeypatch):
+    monkeypatch.setattr(PageFetchEngine, "_fetch_page", fake_fetch)
+    pacing = RateController(Pacing())
+    first = PageFetchEngine(task_id, pacing, stop_poll_interval=0.05)
+    writing = threading.Event()
+    resume_writes = threading.Event()
+    keep_new = PageFetchEngine._keep_new
+
+    def held_keep_new(engine, batch):
+        # the first engine stops in the middle of writing page 3
+        if engine is first and engine.task.current_page == 3:
+            writing.set()
+            resume_writes.wait()
+        return keep_new(engine, batch)
+
+    monkeypatch.setattr(PageFetchEngine, "_keep_new", held_keep_new)
+
+    async def run():
+        fill_pool(4)
+        first_run = asyncio.ensure_future(first.run())
+        while not writing.is_set():
+            await asyncio.sleep(0.01)
+        await db_writer.flush()
+
+        # the lease ran out: a second worker resumes the task from its last
+        # checkpoint, the first one learns of it only afterwards
+        second = PageFetchEngine(task_id, pacing, stop_poll_interval=0.05)
+        second_run = asyncio.ensure_future(second.run())
+        while second not in PageFetchEngine.running:
+            await asyncio.sleep(0.01)
+        first.abandon()
+        first_run.cancel()
+        resume_writes.set()
+        await asyncio.gather(first_run, return_exceptions=True)
+        await second_run
+        await db_writer.flush()
+
+    asyncio.run(run())
+
+    session = SessionLocal()
+    task = session.get(TaskDB, task_id)
+    ids = list(read_output_ids(task.data_file_path, "csv"))
+    assert len(ids) == len(set(ids))
+    assert set(ids) == {r["id"] for page in range(PAGES) for r in page_records(page)}
+    assert task.done and task.current_page == PAGES
+    assert task.rows == PAGES * ROWS
+    checkpoint = (
+        session.query(TaskCheckpointDB)
+        .filter(TaskCheckpointDB.task_id == task_id)
+        .order_by(TaskCheckpointDB.page.desc(), TaskCheckpointDB.id.desc())
+        .first()
+    )
+    assert checkpoint.page == PAGES and checkpoint.rows == PAGES * ROWS
+    assert checkpoint.offset == os.path.getsize(task.data_file_path)
+    session.close()
+
+
+def test_slow_decode_keeps_cooldown(task_id, monkeypatch):
+    # the first page decodes fast and sets the latency baseline, the others
+    # wait on the ingest pool far longer than upstream took to answer
+    decode = page_decoder.decode
+    decoded = []
+
+    async def slow_decode(body, charset, since):
+        if decoded:
+            await asyncio.sleep(0.3)
+        decoded.append(body)
+        return await decode(body, charset, since)
+
+    monkeypatch.setattr(page_decoder, "decode", slow_decode)
+    monkeypatch.setattr(page_decoder.config, "executor", "thread")
+    config = Pacing()
+    config.sleep_time = config.min_sleep_time = 0.05
+    config.max_sleep_time = 10
+    config.adaptive = True
+    pacing = RateController(config)
+
+    async def run():
+        mock = MockAntgst(
+            MockConfig(latency=0.01, jitter=0, total_rows=300, max_page_size=100)
+        )
+        server = TestServer(mock.app())
+        await server.start_server()
+        monkeypatch.setattr(
+            fetch_engine,
+            "SEND_RECORD_LIST_URL",
+            str(server.make_url("/antgst/sms/otpPremium/channel/sendRecordList")),
+        )
+        fill_pool(0)
+        account_pool.accounts["user0"] = PooledAccount("user0", token_for("user0"))
+        try:
+            await PageFetchEngine(task_id, pacing).run()
+        finally:
+            await http_client.close()
+            await server.close()
+            page_decoder.close()
+
+    asyncio.run(run())
+
+    session = SessionLocal()
+    assert session.get(TaskDB, task_id).done
+    session.close()
+    assert len(decoded) == 3
+    assert pacing.pacers["user0"].latency < 0.2
+    assert pacing.delay("user0") == 0.05
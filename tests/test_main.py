@@ -0,0 +1,34 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from record_store import record_store_config
+
+
+def get(path: str, **params) -> httpx.Response:
+    async def request():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await client.get(path, params=params)
+
+    return asyncio.run(request())
+
+
+@pytest.mark.parametrize("limit", ["abc", "-1", "0", "1001"])
+def test_records_rejects_bad_limit(limit, monkeypatch):
+    monkeypatch.setattr(record_store_config, "enabled", True)
+    response = get("/api/records", limit=limit)
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["query", "limit"]
+
+
+def test_records_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(record_store_config, "enabled", True)
+    monkeypatch.setattr(record_store_config, "path", str(tmp_path / "records.db"))
+    response = get("/api/records", limit="5")
+    assert response.status_code == 200
+    assert response.json()["records"] == []